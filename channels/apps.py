@@ -1,9 +1,14 @@
 from django.apps import AppConfig
 
+from .loops import get_loop_options, install_loop_policy
+
+# The event loop policy needs setting before Daphne makes its reactor's loop
+install_loop_policy(get_loop_options()["loop"])
+
 # We import this here to ensure the reactor is installed very early on
 # in case other packages accidentally import twisted.internet.reactor
 # (e.g. raven does this).
-import daphne.server
+import daphne.server  # isort:skip
 
 assert daphne.server  # pyflakes doesn't support ignores
 
@@ -5,7 +5,7 @@ from bulb.db.node_models import BaseNodeAndRelationship
 from bulb.db import gdbh
 from django.utils.functional import LazyObject
 
-from channels.db import database_sync_to_async
+from channels.db import maybe_coalesced_database_sync_to_async
 from channels.middleware import BaseMiddleware
 from channels.sessions import CookieMiddleware, SessionMiddleware
 import base64
@@ -14,7 +14,7 @@ import base64
 AnonymousUser = get_anonymoususer_node_model()
 User = get_user_node_model()
 
-@database_sync_to_async
+@maybe_coalesced_database_sync_to_async
 def get_user(scope):
     """
     Return the user model instance associated with the given scope.
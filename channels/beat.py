@@ -0,0 +1,228 @@
+import datetime
+import heapq
+import itertools
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def parse_cron_field(field, low, high):
+    """
+    Returns the set of values a cron field (like "*", "*/15", "1-5" or
+    "0,30") matches, between low and high inclusive.
+    """
+    values = set()
+    for item in field.split(","):
+        step = 1
+        if "/" in item:
+            item, step = item.split("/", 1)
+            step = int(step)
+        if item == "*":
+            start, end = low, high
+        elif "-" in item:
+            start, end = (int(value) for value in item.split("-", 1))
+        else:
+            start = int(item)
+            # "5/10" means every ten from five onwards
+            end = high if step > 1 else start
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError("Invalid cron field %r" % field)
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronSchedule:
+    """
+    Schedule from a five-field cron expression (minute, hour, day of month,
+    month, day of week), in local time. Days of the week run from 0 (Sunday)
+    to 6, with 7 also meaning Sunday.
+
+    Across daylight saving changes, runs in the hour the clocks skip happen
+    an hour later, and runs in the hour they repeat happen only the first
+    time round.
+    """
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("Cron expression %r needs five fields" % expression)
+        self.expression = expression
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12)
+        self.weekdays = frozenset(day % 7 for day in parse_cron_field(fields[4], 0, 7))
+        # As in cron, if both day fields are restricted, either may match
+        self.either_day = fields[2] != "*" and fields[4] != "*"
+
+    def day_matches(self, moment):
+        day = moment.day in self.days
+        # Python counts weekdays from Monday, cron from Sunday
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.either_day:
+            return day or weekday
+        return day and weekday
+
+    def next_after(self, timestamp):
+        """
+        Returns the timestamp of the first matching minute after the given one.
+        """
+        moment = datetime.datetime.fromtimestamp(timestamp).replace(
+            second=0, microsecond=0
+        ) + datetime.timedelta(minutes=1)
+        # Skip whole months, days and hours that can't match. Even rare
+        # matches (like February 29th on a Monday) turn up within a couple
+        # of thousand steps, so give up on expressions that never match
+        for _ in range(10000):
+            if moment.month not in self.months:
+                year, month = divmod(moment.month, 12)
+                moment = moment.replace(
+                    year=moment.year + year, month=month + 1, day=1, hour=0, minute=0
+                )
+            elif not self.day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            else:
+                if moment.minute in self.minutes:
+                    # Local times repeated when the clocks go back have two
+                    # timestamps (told apart by fold); take the first one
+                    # still to come
+                    for fold in (0, 1):
+                        fire_at = moment.replace(fold=fold).timestamp()
+                        if fire_at > timestamp:
+                            return fire_at
+                moment += datetime.timedelta(minutes=1)
+        raise ValueError("Cron expression %r never matches" % self.expression)
+
+
+class IntervalSchedule:
+    """
+    Schedule that comes due every so many seconds.
+    """
+
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError("Schedule interval must be positive")
+        self.seconds = seconds
+
+    def next_after(self, timestamp):
+        return timestamp + self.seconds
+
+
+class BeatEntry:
+    """
+    A message to send to a channel on a schedule.
+
+    Each run is sent up to jitter seconds late, picked at random, so
+    schedules that share a due time don't all fire at once. If runs were
+    missed (say the event loop was blocked, or the process suspended),
+    catch_up decides what happens once it gets going again:
+
+    * "once" sends a single message for all of them
+    * "all" sends one message per missed run
+    * "skip" sends nothing, and waits for the next run
+    """
+
+    catch_up_policies = ("once", "all", "skip")
+
+    def __init__(self, name, channel, message, schedule, jitter=0, catch_up="once"):
+        if not message.get("type", None):
+            raise ValueError("Beat entry %r has a message with no type" % name)
+        if catch_up not in self.catch_up_policies:
+            raise ValueError(
+                "Beat entry %r has unknown catch_up policy %r" % (name, catch_up)
+            )
+        self.name = name
+        self.channel = channel
+        self.message = message
+        self.schedule = schedule
+        self.jitter = jitter
+        self.catch_up = catch_up
+
+
+class Beat:
+    """
+    Keeps the next run of every entry on a single heap, ordered by the time
+    it should fire, so one timer can serve any number of schedules.
+    """
+
+    def __init__(self, entries, now=None):
+        self.heap = []
+        self.counter = itertools.count()
+        if now is None:
+            now = time.time()
+        for entry in entries:
+            self.push(entry, entry.schedule.next_after(now))
+
+    @classmethod
+    def from_settings(cls, channels=None):
+        """
+        Makes a beat from the CHANNELS_BEAT setting, a dict of entry names to
+        dicts of BeatEntry arguments with either a "cron" expression or an
+        "interval" in seconds. Only entries for the given channels are kept.
+        """
+        entries = []
+        for name, config in getattr(settings, "CHANNELS_BEAT", {}).items():
+            config = dict(config)
+            if channels is not None and config.get("channel") not in channels:
+                continue
+            cron = config.pop("cron", None)
+            interval = config.pop("interval", None)
+            if (cron is None) == (interval is None):
+                raise ImproperlyConfigured(
+                    "CHANNELS_BEAT entry %r needs one of cron or interval" % name
+                )
+            try:
+                if cron is not None:
+                    schedule = CronSchedule(cron)
+                else:
+                    schedule = IntervalSchedule(interval)
+                entries.append(BeatEntry(name, schedule=schedule, **config))
+            except (TypeError, ValueError) as e:
+                raise ImproperlyConfigured(
+                    "Invalid CHANNELS_BEAT entry %r: %s" % (name, e)
+                )
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, entry, due):
+        """
+        Schedules an entry's run due at the given time, with its jitter.
+        """
+        fire_at = due + random.uniform(0, entry.jitter) if entry.jitter else due
+        heapq.heappush(self.heap, (fire_at, next(self.counter), due, entry))
+
+    def next_fire(self):
+        """
+        Returns the time the next run should fire, or None if there are none.
+        """
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """
+        Returns (channel, message) tuples for every run due to fire by now,
+        following each entry's catch_up policy, and schedules their next runs.
+        """
+        messages = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, due, entry = heapq.heappop(self.heap)
+            # Count up runs that were missed while this one waited
+            runs = 1
+            due = entry.schedule.next_after(due)
+            while due <= now:
+                runs += 1
+                due = entry.schedule.next_after(due)
+            if entry.catch_up == "all":
+                sends = runs
+            elif entry.catch_up == "skip":
+                sends = 1 if runs == 1 else 0
+            else:
+                sends = 1
+            messages.extend((entry.channel, dict(entry.message)) for _ in range(sends))
+            self.push(entry, due)
+        return messages
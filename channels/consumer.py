@@ -1,12 +1,15 @@
 import functools
+import threading
+import time
 
 from asgiref.sync import async_to_sync
 
 from . import DEFAULT_CHANNEL_LAYER
 from .db import database_sync_to_async
-from .exceptions import StopConsumer
+from .exceptions import ExecutorFull, StopConsumer
+from .executors import resubmitting
 from .layers import get_channel_layer
-from .utils import await_many_dispatch
+from .utils import DispatchLoop
 
 
 def get_handler_name(message):
@@ -17,10 +20,20 @@ def get_handler_name(message):
     # Check message looks OK
     if "type" not in message:
         raise ValueError("Incoming message has no 'type' attribute")
-    if message["type"].startswith("_"):
+    return get_type_handler_name(message["type"])
+
+
+@functools.lru_cache(maxsize=1024)
+def get_type_handler_name(message_type):
+    """
+    Returns the handler name for a message type. Memoized, as most consumers
+    only ever see a handful of types; the cache is bounded, as anyone who
+    can send to a consumer can make up new ones.
+    """
+    if message_type.startswith("_"):
         raise ValueError("Malformed type in message (leading underscore)")
-    # Extract type and replace . with _
-    return message["type"].replace(".", "_")
+    # Replace . with _
+    return message_type.replace(".", "_")
 
 
 class AsyncConsumer:
@@ -28,13 +41,60 @@ class AsyncConsumer:
     Base consumer class. Implements the ASGI application spec, and adds on
     channel layer management and routing of events to named methods based
     on their type.
+
+    Instance state lives in __slots__. Attributes set by subclasses go in the
+    usual __dict__, which is only created once something is stored in it.
     """
 
+    __slots__ = (
+        "scope",
+        "channel_layer",
+        "_channel_name",
+        "asgi_send",
+        "base_send",
+        "dispatch_loop",
+        "channel_receive",
+        "_groups",
+        "__dict__",
+    )
+
     _sync = False
     channel_layer_alias = DEFAULT_CHANNEL_LAYER
 
+    # Number of handlers allowed to run at once; see ordering_key()
+    max_concurrent_handlers = 1
+
+    # Most messages passed to a <type>_batch handler in one go, and the most
+    # seconds to wait for the rest of a batch to come in; see dispatch_batch()
+    batch_size = 100
+    batch_timeout = 0.01
+
+    # Gets the timings and errors of every message handled, if set; see
+    # channels.instrumentation.HistogramRecorder
+    recorder = None
+
     def __init__(self, scope):
         self.scope = scope
+        # Set once the consumer starts listening on its channel layer channel
+        self.channel_receive = None
+
+    def get_handler(self, message):
+        """
+        Returns the (bound) handler method for the message's type, or None if
+        there is no handler for it. Only the type's handler name is cached;
+        the handler itself is looked up on the instance every time, so
+        static, class and per-instance handlers and __getattr__ all work.
+        """
+        return getattr(self, get_handler_name(message), None)
+
+    def get_batch_handler(self, message):
+        """
+        Returns the (bound) batch handler method for the message's type (the
+        handler name with _batch on the end), or None if there is none. As
+        with get_handler(), nothing per type is kept apart from the bounded
+        handler name cache.
+        """
+        return getattr(self, get_handler_name(message) + "_batch", None)
 
     async def __call__(self, receive, send):
         """
@@ -43,37 +103,184 @@ class AsyncConsumer:
         # Initialize channel layer
         self.channel_layer = get_channel_layer(self.channel_layer_alias)
         if self.channel_layer is not None:
-            self.channel_name = await self.channel_layer.new_channel()
-            self.channel_receive = functools.partial(
-                self.channel_layer.receive, self.channel_name
-            )
-        # Store send function
-        if self._sync:
-            self.base_send = async_to_sync(send)
-        else:
+            self._channel_name = await self.channel_layer.new_channel()
+        # Store send function (sync consumers wrap it when first needed)
+        self.asgi_send = send
+        if not self._sync:
             self.base_send = send
-        # Pass messages in from channel layer or client to dispatch method
+        # Pass messages in from client to dispatch method, and from the
+        # channel layer too once we listen on it
+        if self.recorder is None:
+            dispatch, dispatch_batch = self.dispatch, self.dispatch_batch
+            ordering_key, batch_key = self.ordering_key, self.batch_key
+        else:
+            # Messages come through as (message, time received) pairs
+            dispatch = self.recorded_dispatch
+            dispatch_batch = self.recorded_dispatch_batch
+            ordering_key = lambda timed: self.ordering_key(timed[0])
+            batch_key = lambda timed: self.batch_key(timed[0])
+            receive = self.timed_receive(receive)
+        self.dispatch_loop = DispatchLoop(
+            dispatch,
+            self.max_concurrent_handlers,
+            ordering_key,
+            batch_key=batch_key,
+            dispatch_batch=dispatch_batch,
+            batch_size=self.batch_size,
+            batch_timeout=self.batch_timeout,
+        )
+        self.dispatch_loop.add(receive)
+        if self.channel_layer is not None and self.current_groups():
+            self.listen_to_channel_layer()
         try:
-            if self.channel_layer is not None:
-                await await_many_dispatch(
-                    [receive, self.channel_receive], self.dispatch
-                )
-            else:
-                await await_many_dispatch([receive], self.dispatch)
+            await self.dispatch_loop.run()
         except StopConsumer:
             # Exit cleanly
             pass
 
+    @property
+    def channel_name(self):
+        """
+        The name of this consumer's channel on the channel layer. Consumers
+        only start listening on it when it is first read (or straight away, if
+        they declare groups), so those that never use the channel layer never
+        pay for a listener.
+        """
+        try:
+            channel_name = self._channel_name
+        except AttributeError:
+            raise AttributeError("Consumer has no channel layer channel")
+        if self.channel_receive is None:
+            self.listen_to_channel_layer()
+        return channel_name
+
+    @channel_name.setter
+    def channel_name(self, value):
+        self._channel_name = value
+
+    @property
+    def groups(self):
+        """
+        The groups this consumer's channel is in (generic consumers add it to
+        them on connect). Subclasses usually list them as a class attribute;
+        otherwise each instance gets its own list, made when first used.
+        """
+        try:
+            return self._groups
+        except AttributeError:
+            self._groups = []
+            return self._groups
+
+    @groups.setter
+    def groups(self, value):
+        self._groups = value
+
+    def current_groups(self):
+        """
+        Returns this consumer's groups without making a list for an instance
+        that hasn't used its own yet.
+        """
+        if type(self).groups is AsyncConsumer.groups:
+            return getattr(self, "_groups", None) or ()
+        return self.groups or ()
+
+    def listen_to_channel_layer(self):
+        """
+        Starts passing messages on our channel layer channel to dispatch.
+        """
+        if self.channel_receive is None and hasattr(self, "dispatch_loop"):
+            self.channel_receive = functools.partial(
+                self.channel_layer.receive, self._channel_name
+            )
+            if self.recorder is None:
+                self.dispatch_loop.add(self.channel_receive)
+            else:
+                self.dispatch_loop.add(self.timed_receive(self.channel_receive))
+
+    def ordering_key(self, message):
+        """
+        When max_concurrent_handlers is above one, returns a key for the
+        message; messages with the same key are handled one at a time, in
+        order, while messages with a None key can be handled in parallel with
+        anything.
+
+        By default, the connection's own events (those whose type starts with
+        the scope type, like websocket.receive) stay in order, and everything
+        else - channel layer events - may run in parallel. Note that this
+        means a layer event can be handled before connect() has finished.
+        """
+        protocol = self.scope.get("type")
+        if protocol and message.get("type", "").startswith(protocol + "."):
+            return protocol
+        return None
+
+    def batch_key(self, message):
+        """
+        Returns the key that messages are batched together under, or None if
+        the message should be handled on its own. By default, messages are
+        batched by type when the class has a batch handler for the type.
+        """
+        if self.get_batch_handler(message) is not None:
+            return message["type"]
+        return None
+
+    def timed_receive(self, consumer_callable):
+        """
+        Wraps a consumer callable to return each message paired with the time
+        it came in, so the recorder can be told how long it waited to be
+        handled. The time travels with the message, so nothing is left behind
+        for messages that never reach a handler.
+        """
+
+        async def receive():
+            message = await consumer_callable()
+            return message, time.perf_counter()
+
+        return receive
+
+    async def recorded_dispatch(self, timed):
+        await self.record(self.dispatch, timed[0], [timed])
+
+    async def recorded_dispatch_batch(self, timed_messages):
+        messages = [message for message, _ in timed_messages]
+        await self.record(self.dispatch_batch, messages, timed_messages)
+
+    async def record(self, dispatch, argument, timed_messages):
+        """
+        Dispatches a message (or batch), passing its age, how long it took to
+        handle and any error to the recorder.
+        """
+        recorder = self.recorder
+        message_type = timed_messages[0][0].get("type")
+        started = time.perf_counter()
+        for _, received in timed_messages:
+            recorder.record("message_age", message_type, started - received)
+        try:
+            await dispatch(argument)
+        except StopConsumer:
+            raise
+        except Exception as exception:
+            recorder.error(message_type, exception)
+            raise
+        finally:
+            recorder.record("handler_time", message_type, time.perf_counter() - started)
+
     async def dispatch(self, message):
         """
         Works out what to do with a message.
         """
-        handler = getattr(self, get_handler_name(message), None)
+        handler = self.get_handler(message)
         if handler:
             await handler(message)
         else:
             raise ValueError("No handler for message type %s" % message["type"])
 
+    async def dispatch_batch(self, messages):
+        """
+        Passes a batch of messages of one type to its batch handler.
+        """
+        await self.get_batch_handler(messages[0])(messages)
+
     async def send(self, message):
         """
         Overrideable/callable-by-subclasses send method.
@@ -92,22 +299,165 @@ class SyncConsumer(AsyncConsumer):
     for user-called methods very confusing as there'd be two types of each.
     """
 
+    __slots__ = ("send_buffer", "send_buffer_thread", "_base_send")
+
     _sync = True
 
-    @database_sync_to_async
-    def dispatch(self, message):
+    # Thread pool to run handlers in, if not the shared default one; see
+    # channels.executors.BoundedThreadPoolExecutor
+    executor = None
+
+    # Whether sends made while handling a message are queued up and passed
+    # to the event loop all at once when the handler returns
+    buffer_sends = False
+
+    def __init__(self, scope):
+        super().__init__(scope)
+        # Sends queued up by the running handler, if buffering, and the
+        # thread it runs in; sends from any other thread go straight out
+        self.send_buffer = None
+        self.send_buffer_thread = None
+
+    @property
+    def base_send(self):
         """
-        Dispatches incoming messages to type-based handlers asynchronously.
+        The ASGI send callable, wrapped to be called from handler threads.
+        Made when first used, as buffered sends never need it.
+        """
+        try:
+            return self._base_send
+        except AttributeError:
+            self._base_send = async_to_sync(self.asgi_send)
+            return self._base_send
+
+    async def dispatch(self, message):
+        """
+        Dispatches incoming messages to type-based handlers in a thread.
+        """
+        await self.run_in_thread(self.sync_dispatch, message)
+
+    async def dispatch_batch(self, messages):
+        """
+        Passes a batch of messages to their batch handler in a thread.
+        """
+        await self.run_in_thread(self.sync_dispatch_batch, messages)
+
+    async def run_in_thread(self, sync_dispatch, argument):
+        """
+        Runs one of the sync dispatch methods in a thread, then sends on
+        anything the handler queued up.
+        """
+        if self.recorder is not None:
+            sync_dispatch = functools.partial(
+                self.timed_in_thread, sync_dispatch, time.perf_counter()
+            )
+        # Concurrent handlers would share the buffer, so they don't get one
+        buffered = self.buffer_sends and self.max_concurrent_handlers <= 1
+        if buffered:
+            sync_dispatch = functools.partial(self.buffered_in_thread, sync_dispatch)
+        if not buffered:
+            await self.call_in_executor(sync_dispatch, argument)
+            return
+        try:
+            await self.call_in_executor(sync_dispatch, argument)
+        finally:
+            messages, self.send_buffer = self.send_buffer, None
+            if messages:
+                await self._send_all(messages)
+
+    async def call_in_executor(self, sync_dispatch, argument):
+        """
+        Runs a sync dispatch method in the consumer's executor. While the
+        executor is too full to take it, waits for room and tries again, so a
+        burst of messages is held back rather than ending the connection.
+        """
+        if self.executor is None:
+            await database_sync_to_async(sync_dispatch)(argument)
+            return
+        started = []
+
+        def run(argument):
+            started.append(True)
+            sync_dispatch(argument)
+
+        run = database_sync_to_async(run, executor=self.executor)
+        token = None
+        try:
+            while True:
+                try:
+                    await run(argument)
+                    return
+                except ExecutorFull:
+                    # Only retry if it was the submission that failed, not the
+                    # handler itself
+                    if started:
+                        raise
+                if token is None:
+                    token = resubmitting.set(True)
+                await self.executor.wait_for_room()
+        finally:
+            if token is not None:
+                resubmitting.reset(token)
+
+    def buffered_in_thread(self, sync_dispatch, argument):
+        """
+        Runs a handler with the sends it makes from its own thread queued up.
+        """
+        self.send_buffer = []
+        self.send_buffer_thread = threading.get_ident()
+        try:
+            sync_dispatch(argument)
+        finally:
+            self.send_buffer_thread = None
+
+    def timed_in_thread(self, sync_dispatch, submitted, argument):
+        """
+        Tells the recorder how long the handler waited for a thread, then
+        runs it.
+        """
+        message = argument[0] if isinstance(argument, list) else argument
+        self.recorder.record(
+            "queue_wait", message.get("type"), time.perf_counter() - submitted
+        )
+        sync_dispatch(argument)
+
+    def sync_dispatch(self, message):
+        """
+        Dispatches incoming messages to type-based handlers synchronously.
         """
         # Get and execute the handler
-        handler = getattr(self, get_handler_name(message), None)
+        handler = self.get_handler(message)
         if handler:
             handler(message)
         else:
             raise ValueError("No handler for message type %s" % message["type"])
 
+    def sync_dispatch_batch(self, messages):
+        """
+        Passes a batch of messages to their batch handler synchronously.
+        """
+        self.get_batch_handler(messages[0])(messages)
+
     def send(self, message):
         """
         Overrideable/callable-by-subclasses send method.
         """
-        self.base_send(message)
+        send_buffer = self.send_buffer
+        if send_buffer is not None and self.send_buffer_thread == threading.get_ident():
+            send_buffer.append(message)
+        else:
+            self.base_send(message)
+
+    def flush(self):
+        """
+        Sends everything the running handler has queued up so far, in one go.
+        Use it from handlers that need the client to see something before
+        they return.
+        """
+        if self.send_buffer and self.send_buffer_thread == threading.get_ident():
+            messages, self.send_buffer = self.send_buffer, []
+            async_to_sync(self._send_all)(messages)
+
+    async def _send_all(self, messages):
+        for message in messages:
+            await self.asgi_send(message)
@@ -1,20 +1,180 @@
+import asyncio
+import functools
+import threading
+import time
+import weakref
+
+from django.conf import settings
 from django.db import close_old_connections
 
 from asgiref.sync import SyncToAsync
 
+try:
+    import contextvars  # Python 3.7+ only.
+except ImportError:
+    contextvars = None
+
 
 class DatabaseSyncToAsync(SyncToAsync):
     """
     SyncToAsync version that cleans up old database connections when it exits.
+
+    Pass an executor to run the function in that pool rather than the
+    shared default one.
+
+    With a cleanup_interval (or the CHANNELS_DB_CLEANUP_INTERVAL setting) of
+    more than zero seconds, each thread instead keeps its connections open
+    across calls and only cleans them up once per interval, or straight
+    after a call that raised.
     """
 
+    # Per-thread time of the last connection cleanup
+    cleanups = threading.local()
+
+    def __init__(
+        self, func, thread_sensitive=False, executor=None, cleanup_interval=None
+    ):
+        # A full BoundedThreadPoolExecutor raises ExecutorFull when the call
+        # is submitted, out of the await
+        super().__init__(func, thread_sensitive=thread_sensitive, executor=executor)
+        self.executor = executor
+        self.cleanup_interval = cleanup_interval
+
     def thread_handler(self, loop, *args, **kwargs):
-        close_old_connections()
+        interval = self.cleanup_interval
+        if interval is None:
+            interval = getattr(settings, "CHANNELS_DB_CLEANUP_INTERVAL", 0)
+        if not interval:
+            close_old_connections()
+            try:
+                return super().thread_handler(loop, *args, **kwargs)
+            finally:
+                close_old_connections()
+        # Reuse mode: connections past CONN_MAX_AGE are closed at the next
+        # cleanup, so they may live up to an interval longer
+        now = time.monotonic()
+        if now - getattr(self.cleanups, "last", float("-inf")) >= interval:
+            close_old_connections()
+            self.cleanups.last = now
         try:
             return super().thread_handler(loop, *args, **kwargs)
-        finally:
+        except Exception:
+            # The error may have left a connection unusable; check them now
             close_old_connections()
+            raise
+
+
+class CoalescedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """
+    DatabaseSyncToAsync version that, rather than making a thread hop per
+    call, collects the calls made on an event loop within window seconds of
+    the first one (or in the same loop iteration, with a window of 0) and
+    runs them back to back in one thread, cleaning up old database
+    connections once for the lot. Each caller still gets its own result or
+    exception, once the whole batch has run.
+    """
+
+    # Event loop -> {executor: calls waiting to be run}
+    pending = weakref.WeakKeyDictionary()
+
+    def __init__(self, func, window=0, max_batch=100, executor=None):
+        super().__init__(func, executor=executor)
+        self.window = window
+        self.max_batch = max_batch
+
+    async def __call__(self, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        batches = self.pending.setdefault(loop, {})
+        batch = batches.get(self.executor)
+        if batch is None:
+            batch = batches[self.executor] = []
+            if self.window:
+                loop.call_later(self.window, self.run_batch, loop, batch)
+            else:
+                loop.call_soon(self.run_batch, loop, batch)
+        func = self.func
+        if contextvars is not None:
+            func = functools.partial(contextvars.copy_context().run, func)
+        future = loop.create_future()
+        batch.append((future, func, args, kwargs))
+        if len(batch) >= self.max_batch:
+            self.run_batch(loop, batch)
+        return await future
+
+    def run_batch(self, loop, batch):
+        """
+        Sends a batch of calls off to a thread, unless it has already gone.
+        """
+        batches = self.pending.get(loop, {})
+        if batches.get(self.executor) is not batch:
+            return
+        del batches[self.executor]
+        # Skip calls whose callers have gone away
+        calls = [call for call in batch if not call[0].done()]
+        if calls:
+            loop.create_task(self.run_calls_in_thread(calls))
+
+    async def run_calls_in_thread(self, calls):
+        """
+        Runs a batch of calls in one thread, with the usual connection
+        cleanup around it, and passes each caller its own outcome.
+        """
+        try:
+            outcomes = await DatabaseSyncToAsync(
+                functools.partial(self.run_calls, calls), executor=self.executor
+            )()
+        except asyncio.CancelledError:
+            for call in calls:
+                call[0].cancel()
+            raise
+        except Exception as exception:
+            # Most likely the executor is full; every caller gets the error
+            outcomes = [(False, exception)] * len(calls)
+        for call, (succeeded, value) in zip(calls, outcomes):
+            if call[0].done():
+                continue
+            if succeeded:
+                call[0].set_result(value)
+            else:
+                call[0].set_exception(value)
+
+    @staticmethod
+    def run_calls(calls):
+        """
+        Runs a batch of calls back to back, returning the outcome of each.
+        """
+        outcomes = []
+        for _, func, args, kwargs in calls:
+            try:
+                result = func(*args, **kwargs)
+            except Exception as exception:
+                outcomes.append((False, exception))
+                # Don't let the rest use a connection this broke
+                close_old_connections()
+            else:
+                outcomes.append((True, result))
+        return outcomes
 
 
 # The class is TitleCased, but we want to encourage use as a callable/decorator
 database_sync_to_async = DatabaseSyncToAsync
+coalesced_database_sync_to_async = CoalescedDatabaseSyncToAsync
+
+
+def maybe_coalesced_database_sync_to_async(func):
+    """
+    Wraps func as coalesced_database_sync_to_async when the
+    CHANNELS_COALESCE_DB_CALLS setting is on, and as database_sync_to_async
+    otherwise; the setting is checked on every call. Channels' own session
+    and user loading go through this.
+    """
+    plain = database_sync_to_async(func)
+    coalesced = coalesced_database_sync_to_async(func)
+
+    @functools.wraps(func)
+    async def inner(*args, **kwargs):
+        if getattr(settings, "CHANNELS_COALESCE_DB_CALLS", False):
+            return await coalesced(*args, **kwargs)
+        return await plain(*args, **kwargs)
+
+    return inner
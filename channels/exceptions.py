@@ -63,3 +63,11 @@ class StopConsumer(Exception):
     """
 
     pass
+
+
+class ExecutorFull(Exception):
+    """
+    Raised when a bounded executor has no room left to queue a call.
+    """
+
+    pass
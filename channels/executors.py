@@ -0,0 +1,141 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .exceptions import ExecutorFull
+
+# Set while a caller submits again a call the executor already turned away,
+# so that the call only counts as rejected once
+resubmitting = contextvars.ContextVar("resubmitting", default=False)
+
+
+class BoundedThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    Thread pool that lets at most max_queue calls wait for a free thread,
+    raising ExecutorFull rather than queueing any more, and that keeps count
+    of how long calls wait and run.
+
+    Give a consumer class or HTTP handler its own pool (via its ``executor``
+    attribute) so a burst of work on it can't starve everything else.
+    Callers that would rather wait than be turned away can await
+    wait_for_room() before submitting again.
+    """
+
+    def __init__(self, max_workers=None, max_queue=100, thread_name_prefix=""):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.queued = 0
+        self.running = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        # (loop, future) pairs for coroutines waiting in wait_for_room()
+        self.room_waiters = []
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            if not self.has_room():
+                if not resubmitting.get():
+                    self.rejected += 1
+                raise ExecutorFull("Executor queue is full (%s)" % self.max_queue)
+            self.queued += 1
+            self.submitted += 1
+        try:
+            return super().submit(
+                self.timed_call, time.perf_counter(), fn, args, kwargs
+            )
+        except BaseException:
+            with self.lock:
+                self.queued -= 1
+                self.submitted -= 1
+                self.wake_room_waiter()
+            raise
+
+    def has_room(self):
+        """
+        Returns whether another call can be queued. Call with the lock held.
+        """
+        return self.max_queue is None or self.queued < self.max_queue
+
+    async def wait_for_room(self):
+        """
+        Waits until the queue has room for another call. Another thread may
+        still fill it first, so be ready for ExecutorFull all the same.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            with self.lock:
+                if self.has_room():
+                    return
+                waiter = loop.create_future()
+                self.room_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self.lock:
+                    if (loop, waiter) in self.room_waiters:
+                        self.room_waiters.remove((loop, waiter))
+                    elif self.has_room():
+                        # Pass on the room we were woken for
+                        self.wake_room_waiter()
+                raise
+
+    def wake_room_waiter(self):
+        """
+        Wakes the longest waiting coroutine in wait_for_room(), if there is
+        one, from whichever thread made room. Call with the lock held.
+        """
+        while self.room_waiters:
+            loop, waiter = self.room_waiters.pop(0)
+            try:
+                loop.call_soon_threadsafe(self.set_room, waiter)
+                return
+            except RuntimeError:
+                # Its loop has closed, so try the next one
+                continue
+
+    @staticmethod
+    def set_room(waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def timed_call(self, submitted_at, fn, args, kwargs):
+        """
+        Runs a submitted call in a pool thread, recording its timings.
+        """
+        started_at = time.perf_counter()
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_time += started_at - submitted_at
+            self.wake_room_waiter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+                self.run_time += time.perf_counter() - started_at
+
+    def stats(self):
+        """
+        Returns a snapshot of the pool's counters. Times are totals in
+        seconds, covering every completed or running call.
+        """
+        with self.lock:
+            return {
+                "max_workers": self._max_workers,
+                "max_queue": self.max_queue,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "queued": self.queued,
+                "running": self.running,
+                "wait_time": self.wait_time,
+                "run_time": self.run_time,
+            }
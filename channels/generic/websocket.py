@@ -17,19 +17,14 @@ class WebsocketConsumer(SyncConsumer):
     WebSocket handling model that other applications can build on.
     """
 
-    groups = None
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        if self.groups is None:
-            self.groups = []
+    __slots__ = ()
 
     def websocket_connect(self, message):
         """
         Called when a WebSocket connection is opened.
         """
         try:
-            for group in self.groups:
+            for group in self.current_groups():
                 async_to_sync(self.channel_layer.group_add)(group, self.channel_name)
         except AttributeError:
             raise InvalidChannelLayerError(
@@ -95,7 +90,7 @@ class WebsocketConsumer(SyncConsumer):
         need to call super() all the time.
         """
         try:
-            for group in self.groups:
+            for group in self.current_groups():
                 async_to_sync(self.channel_layer.group_discard)(
                     group, self.channel_name
                 )
@@ -120,6 +115,8 @@ class JsonWebsocketConsumer(WebsocketConsumer):
     error on binary data.
     """
 
+    __slots__ = ()
+
     def receive(self, text_data=None, bytes_data=None, **kwargs):
         if text_data:
             self.receive_json(self.decode_json(text_data), **kwargs)
@@ -153,19 +150,14 @@ class AsyncWebsocketConsumer(AsyncConsumer):
     for the WebSocket handling model that other applications can build on.
     """
 
-    groups = None
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        if self.groups is None:
-            self.groups = []
+    __slots__ = ()
 
     async def websocket_connect(self, message):
         """
         Called when a WebSocket connection is opened.
         """
         try:
-            for group in self.groups:
+            for group in self.current_groups():
                 await self.channel_layer.group_add(group, self.channel_name)
         except AttributeError:
             raise InvalidChannelLayerError(
@@ -231,7 +223,7 @@ class AsyncWebsocketConsumer(AsyncConsumer):
         need to call super() all the time.
         """
         try:
-            for group in self.groups:
+            for group in self.current_groups():
                 await self.channel_layer.group_discard(group, self.channel_name)
         except AttributeError:
             raise InvalidChannelLayerError(
@@ -254,6 +246,8 @@ class AsyncJsonWebsocketConsumer(AsyncWebsocketConsumer):
     error on binary data.
     """
 
+    __slots__ = ()
+
     async def receive(self, text_data=None, bytes_data=None, **kwargs):
         if text_data:
             await self.receive_json(await self.decode_json(text_data), **kwargs)
@@ -1,25 +1,285 @@
+import asyncio
 import cgi
 import codecs
+import collections
+import functools
+import io
 import logging
 import sys
 import tempfile
+import threading
+import time
 import traceback
 
 from django import http
 from django.conf import settings
 from django.core import signals
-from django.core.exceptions import RequestDataTooBig
-from django.core.handlers import base
+from django.core.exceptions import (
+    ImproperlyConfigured,
+    MiddlewareNotUsed,
+    RequestDataTooBig,
+)
+from django.core.handlers import base, exception
 from django.http import FileResponse, HttpResponse, HttpResponseServerError
 from django.urls import set_script_prefix
 from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
 
-from asgiref.sync import async_to_sync, sync_to_async
-from channels.exceptions import RequestAborted, RequestTimeout
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.exceptions import ExecutorFull, RequestAborted, RequestTimeout
 
 logger = logging.getLogger("django.request")
 
 
+@functools.lru_cache(maxsize=1024)
+def header_meta_key(name):
+    """
+    Returns the META key for a raw (lowercase bytes) header name. Memoized,
+    as the same few header names turn up on nearly every request.
+    """
+    name = name.decode("latin1")
+    if name == "content-length":
+        return "CONTENT_LENGTH"
+    elif name == "content-type":
+        return "CONTENT_TYPE"
+    return "HTTP_%s" % name.upper().replace("-", "_")
+
+
+@functools.lru_cache(maxsize=256)
+def parse_content_type(value):
+    """
+    Memoized cgi.parse_header(); copy the params before changing them.
+    """
+    return cgi.parse_header(value)
+
+
+@functools.lru_cache(maxsize=64)
+def is_known_charset(charset):
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        return False
+    return True
+
+
+class AsgiMeta(dict):
+    """
+    Request META dict backed by the request's raw headers, which are only
+    decoded into it when something looks for a key it doesn't already have,
+    or at the whole dict. Keys set before then win over headers of the same
+    name.
+
+    Copying it (with dict(), ``{**META}``, copy or json.dumps) goes through
+    keys() or __iter__, so gets the headers too; only calling dict's own
+    methods on it directly, like dict.get(META, key), skips them.
+    """
+
+    def __init__(self, values, headers):
+        super().__init__(values)
+        self.headers = headers
+
+    def load_headers(self):
+        headers = self.headers
+        if headers is None:
+            return
+        self.headers = None
+        loaded = {}
+        for name, value in headers:
+            key = header_meta_key(name)
+            # HTTPbis say only ASCII chars are allowed in headers, but we latin1 just in case
+            value = value.decode("latin1")
+            if key in loaded:
+                value = loaded[key] + "," + value
+            loaded[key] = value
+        # Put back anything set since
+        loaded.update(dict.items(self))
+        dict.update(self, loaded)
+
+    def load_headers_for(self, key):
+        if self.headers is not None and not dict.__contains__(self, key):
+            self.load_headers()
+
+    def get_header(self, name):
+        """
+        Returns the value of a raw header name, or None if it wasn't sent,
+        without loading the others.
+        """
+        if self.headers is None:
+            return self.get(header_meta_key(name))
+        values = [value for key, value in self.headers if key == name]
+        if not values:
+            return None
+        return b",".join(values).decode("latin1")
+
+    def __getitem__(self, key):
+        self.load_headers_for(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.load_headers_for(key)
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        self.load_headers_for(key)
+        return dict.get(self, key, default)
+
+    def setdefault(self, key, default=None):
+        self.load_headers_for(key)
+        return super().setdefault(key, default)
+
+    def __delitem__(self, key):
+        self.load_headers()
+        super().__delitem__(key)
+
+    def pop(self, key, *args):
+        self.load_headers()
+        return super().pop(key, *args)
+
+    def popitem(self):
+        self.load_headers()
+        return super().popitem()
+
+    def __iter__(self):
+        self.load_headers()
+        return super().__iter__()
+
+    def __len__(self):
+        self.load_headers()
+        return super().__len__()
+
+    def __eq__(self, other):
+        self.load_headers()
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        self.load_headers()
+        return super().__ne__(other)
+
+    def __repr__(self):
+        self.load_headers()
+        return super().__repr__()
+
+    def __reversed__(self):
+        self.load_headers()
+        return super().__reversed__()
+
+    def keys(self):
+        self.load_headers()
+        return super().keys()
+
+    def items(self):
+        self.load_headers()
+        return super().items()
+
+    def values(self):
+        self.load_headers()
+        return super().values()
+
+    def copy(self):
+        self.load_headers()
+        return super().copy()
+
+
+class BodyPipe(io.RawIOBase):
+    """
+    Bounded pipe carrying a request body from the event loop, which calls
+    write() and finish(), to the view's thread, which reads it like a file.
+
+    Writes wait while max_buffer bytes or more are waiting to be read, and
+    reads wait up to timeout seconds for more to arrive before raising
+    RequestTimeout. With a total_timeout, reads also raise RequestTimeout
+    once that many seconds have passed and the body still isn't finished.
+    Once the body is finished, reads return what is left and then end, or
+    raise the error it was finished with.
+    """
+
+    def __init__(self, max_buffer=64 * 1024, timeout=None, total_timeout=None):
+        super().__init__()
+        self.max_buffer = max_buffer
+        self.timeout = timeout
+        self.deadline = None
+        if total_timeout is not None:
+            self.deadline = time.monotonic() + total_timeout
+        self.loop = asyncio.get_event_loop()
+        self.condition = threading.Condition()
+        self.chunks = collections.deque()
+        self.buffered = 0
+        self.finished = False
+        self.error = None
+        # Future a waiting write() is waiting on, if any
+        self.space = None
+
+    def readable(self):
+        return True
+
+    async def write(self, chunk):
+        while True:
+            with self.condition:
+                if self.buffered < self.max_buffer:
+                    self.chunks.append(memoryview(chunk))
+                    self.buffered += len(chunk)
+                    self.condition.notify()
+                    return
+                self.space = self.loop.create_future()
+                space = self.space
+            await space
+
+    def finish(self, error=None):
+        """
+        Marks the end of the body, or that it will never finish because of
+        the given error. Only the first call counts.
+        """
+        with self.condition:
+            if not self.finished:
+                self.finished = True
+                self.error = error
+                self.condition.notify_all()
+
+    def wait_time(self):
+        """
+        Returns how long a read may wait for more of the body, or None for
+        as long as it takes.
+        """
+        if self.deadline is None:
+            return self.timeout
+        remaining = max(0, self.deadline - time.monotonic())
+        return remaining if self.timeout is None else min(self.timeout, remaining)
+
+    def readinto(self, buffer):
+        with self.condition:
+            if (
+                self.deadline is not None
+                and not self.finished
+                and time.monotonic() >= self.deadline
+            ):
+                raise RequestTimeout()
+            while not self.chunks and not self.finished:
+                if not self.condition.wait(self.wait_time()):
+                    raise RequestTimeout()
+            if not self.chunks:
+                if self.error is not None:
+                    raise self.error
+                return 0
+            chunk = self.chunks[0]
+            size = min(len(buffer), len(chunk))
+            buffer[:size] = chunk[:size]
+            if size == len(chunk):
+                self.chunks.popleft()
+            else:
+                self.chunks[0] = chunk[size:]
+            self.buffered -= size
+            if self.space is not None and self.buffered < self.max_buffer:
+                self.loop.call_soon_threadsafe(self.wake, self.space)
+                self.space = None
+            return size
+
+    @staticmethod
+    def wake(space):
+        if not space.done():
+            space.set_result(None)
+
+
 class AsgiRequest(http.HttpRequest):
     """
     Custom request subclass that decodes from an ASGI-standard request
@@ -58,15 +318,24 @@ class AsgiRequest(http.HttpRequest):
         query_string = self.scope.get("query_string", "")
         if isinstance(query_string, bytes):
             query_string = query_string.decode("utf-8")
-        self.META = {
-            "REQUEST_METHOD": self.method,
-            "QUERY_STRING": query_string,
-            "SCRIPT_NAME": self.script_name,
-            "PATH_INFO": self.path_info,
-            # Old code will need these for a while
-            "wsgi.multithread": True,
-            "wsgi.multiprocess": True,
-        }
+        # Handle old style-headers for a transition period
+        if "headers" in self.scope and isinstance(self.scope["headers"], dict):
+            self.scope["headers"] = [
+                (x.encode("latin1"), y) for x, y in self.scope["headers"].items()
+            ]
+        # Headers go into META as they are needed
+        self.META = AsgiMeta(
+            {
+                "REQUEST_METHOD": self.method,
+                "QUERY_STRING": query_string,
+                "SCRIPT_NAME": self.script_name,
+                "PATH_INFO": self.path_info,
+                # Old code will need these for a while
+                "wsgi.multithread": True,
+                "wsgi.multiprocess": True,
+            },
+            self.scope.get("headers", []),
+        )
         if self.scope.get("client", None):
             self.META["REMOTE_ADDR"] = self.scope["client"][0]
             self.META["REMOTE_HOST"] = self.META["REMOTE_ADDR"]
@@ -77,43 +346,22 @@ class AsgiRequest(http.HttpRequest):
         else:
             self.META["SERVER_NAME"] = "unknown"
             self.META["SERVER_PORT"] = "0"
-        # Handle old style-headers for a transition period
-        if "headers" in self.scope and isinstance(self.scope["headers"], dict):
-            self.scope["headers"] = [
-                (x.encode("latin1"), y) for x, y in self.scope["headers"].items()
-            ]
-        # Headers go into META
-        for name, value in self.scope.get("headers", []):
-            name = name.decode("latin1")
-            if name == "content-length":
-                corrected_name = "CONTENT_LENGTH"
-            elif name == "content-type":
-                corrected_name = "CONTENT_TYPE"
-            else:
-                corrected_name = "HTTP_%s" % name.upper().replace("-", "_")
-            # HTTPbis say only ASCII chars are allowed in headers, but we latin1 just in case
-            value = value.decode("latin1")
-            if corrected_name in self.META:
-                value = self.META[corrected_name] + "," + value
-            self.META[corrected_name] = value
         # Pull out request encoding if we find it
-        if "CONTENT_TYPE" in self.META:
-            self.content_type, self.content_params = cgi.parse_header(
-                self.META["CONTENT_TYPE"]
-            )
-            if "charset" in self.content_params:
-                try:
-                    codecs.lookup(self.content_params["charset"])
-                except LookupError:
-                    pass
-                else:
-                    self.encoding = self.content_params["charset"]
+        content_type = self.META.get_header(b"content-type")
+        if content_type is not None:
+            self.content_type, content_params = parse_content_type(content_type)
+            self.content_params = dict(content_params)
+            charset = self.content_params.get("charset")
+            if charset is not None and is_known_charset(charset):
+                # Not through the encoding setter, as there's nothing to reset
+                self._encoding = charset
         else:
             self.content_type, self.content_params = "", {}
         # Pull out content length info
-        if self.META.get("CONTENT_LENGTH", None):
+        content_length = self.META.get_header(b"content-length")
+        if content_length:
             try:
-                self._content_length = int(self.META["CONTENT_LENGTH"])
+                self._content_length = int(content_length)
             except (ValueError, TypeError):
                 pass
         # Body handling
@@ -166,6 +414,29 @@ class AsgiHandler(base.BaseHandler):
     # Size to chunk response bodies into for multiple response messages
     chunk_size = 512 * 1024
 
+    # Thread pool to run views in, if not the shared default one; see
+    # channels.executors.BoundedThreadPoolExecutor
+    executor = None
+
+    # Whether to answer 413 without reading the body when its Content-Length
+    # is over DATA_UPLOAD_MAX_MEMORY_SIZE. Multipart bodies are exempt, as
+    # Django doesn't count their files towards that limit. The unread body
+    # is left for the server to discard, or to close the connection over.
+    reject_large_bodies = False
+
+    # Whether to start the view as soon as the request arrives, and stream
+    # the body to it as it comes in (through at most stream_buffer_size
+    # bytes of buffer) rather than reading all of it first. The view holds
+    # its thread until the body is in, so stream_body_timeout caps how many
+    # seconds that may take in all (on top of the request class's
+    # body_receive_timeout between chunks).
+    stream_request_body = False
+    stream_buffer_size = 64 * 1024
+    stream_body_timeout = None
+
+    # The BodyPipe a streamed body comes through
+    body_pipe = None
+
     def __init__(self, scope):
         if scope["type"] != "http":
             raise ValueError(
@@ -184,34 +455,157 @@ class AsgiHandler(base.BaseHandler):
         self.send = async_to_sync(send)
 
         # Receive the HTTP request body as a stream object.
+        body_reader = None
         try:
-            body_stream = await self.read_body(receive)
+            if self.stream_request_body:
+                self.check_body_size()
+                self.body_pipe = BodyPipe(
+                    self.stream_buffer_size,
+                    self.request_class.body_receive_timeout,
+                    self.stream_body_timeout,
+                )
+                body_reader = asyncio.ensure_future(
+                    self.stream_body(receive, self.body_pipe)
+                )
+                body_stream = io.BufferedReader(self.body_pipe)
+            else:
+                body_stream = await self.read_body(receive)
         except RequestAborted:
             return
+        except RequestDataTooBig:
+            await self.send_response(
+                send, HttpResponse("413 Payload too large", status=413)
+            )
+            return
         # Launch into body handling (and a synchronous subthread).
-        await self.handle(body_stream)
+        try:
+            await database_sync_to_async(self.handle, executor=self.executor)(
+                body_stream
+            )
+        except ExecutorFull:
+            # Shed the request rather than queue it behind everything else
+            await self.send_response(
+                send, HttpResponse("503 Service Unavailable", status=503)
+            )
+        finally:
+            # Stop streaming any of the body the view didn't read
+            if body_reader is not None:
+                body_reader.cancel()
+
+    async def send_response(self, send, response):
+        """
+        Sends a response straight from the event loop, for requests turned
+        away before they get to a view.
+        """
+        for response_message in self.encode_response(response):
+            await send(response_message)
+
+    def get_body_headers(self):
+        """
+        Returns the request's Content-Length (or None if it has no valid one)
+        and Content-Type (as bytes) from its scope.
+        """
+        headers = self.scope.get("headers", [])
+        if isinstance(headers, dict):
+            headers = [
+                (name.encode("latin1"), value) for name, value in headers.items()
+            ]
+        content_length = None
+        content_type = b""
+        for name, value in headers:
+            if name == b"content-length":
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    pass
+            elif name == b"content-type":
+                content_type = value
+        return content_length, content_type
+
+    def check_body_size(self):
+        """
+        Raises RequestDataTooBig if the request says its body is too large to
+        accept, and otherwise returns its Content-Length, if it has one.
+        """
+        content_length, content_type = self.get_body_headers()
+        if (
+            self.reject_large_bodies
+            and content_length is not None
+            and settings.DATA_UPLOAD_MAX_MEMORY_SIZE is not None
+            and content_length > settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+            and not content_type.startswith(b"multipart/")
+        ):
+            raise RequestDataTooBig(
+                "Request body exceeded settings.DATA_UPLOAD_MAX_MEMORY_SIZE."
+            )
+        return content_length
+
+    async def stream_body(self, receive, body_pipe):
+        """
+        Feeds the HTTP body from an ASGI connection into a BodyPipe as it
+        arrives, for a view that is already running.
+        """
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    # Early client disconnect; the view gets RequestAborted
+                    return
+                if message.get("body"):
+                    await body_pipe.write(message["body"])
+                if not message.get("more_body", False):
+                    body_pipe.finish()
+                    return
+        finally:
+            # If we didn't get to the end, the view never will
+            body_pipe.finish(RequestAborted())
 
     async def read_body(self, receive):
-        """Reads a HTTP body from an ASGI connection."""
-        # Use the tempfile that auto rolls-over to a disk file as it fills up.
-        body_file = tempfile.SpooledTemporaryFile(
-            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE, mode="w+b"
-        )
+        """
+        Reads a HTTP body from an ASGI connection.
+
+        Bodies up to FILE_UPLOAD_MAX_MEMORY_SIZE are gathered in memory,
+        larger ones go to a temporary file that rolls over to disk.
+        """
+        content_length = self.check_body_size()
+        max_memory_size = settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+        chunks = []
+        size = 0
+        body_file = None
+        if content_length is not None and content_length > max_memory_size:
+            body_file = self.make_body_file()
         while True:
             message = await receive()
             if message["type"] == "http.disconnect":
                 # Early client disconnect.
                 raise RequestAborted()
             # Add a body chunk from the message, if provided.
-            if "body" in message:
-                body_file.write(message["body"])
+            chunk = message.get("body", b"")
+            if body_file is not None:
+                body_file.write(chunk)
+            elif chunk:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > max_memory_size:
+                    # Too big to keep in memory after all
+                    body_file = self.make_body_file()
+                    body_file.write(b"".join(chunks))
+                    chunks = None
             # Quit out if that's the end.
             if not message.get("more_body", False):
                 break
+        if body_file is None:
+            # A single chunk needs no copying; BytesIO shares it until written
+            return io.BytesIO(chunks[0] if len(chunks) == 1 else b"".join(chunks))
         body_file.seek(0)
         return body_file
 
-    @sync_to_async
+    def make_body_file(self):
+        # Use the tempfile that auto rolls-over to a disk file as it fills up.
+        return tempfile.SpooledTemporaryFile(
+            max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE, mode="w+b"
+        )
+
     def handle(self, body):
         """
         Synchronous message processing.
@@ -242,6 +636,11 @@ class AsgiHandler(base.BaseHandler):
             response = HttpResponse("413 Payload too large", status=413)
         else:
             response = self.get_response(request)
+            if self.body_pipe is not None and self.body_pipe.error is not None:
+                # The client went away part way through the body, so there's
+                # no one to send the response to
+                response.close()
+                return
             # Fix chunk size on file responses
             if isinstance(response, FileResponse):
                 response.block_size = 1024 * 512
@@ -267,6 +666,26 @@ class AsgiHandler(base.BaseHandler):
                 content_type="text/plain",
             )
 
+    def convert_exception_to_response(self, get_response):
+        """
+        Wraps a layer of the middleware chain (or the view) as Django does,
+        but first turns a streamed body that stalls or is cut short while it
+        reads it into a 408 (or a 400 nobody gets, once handle() sees the
+        client has gone). These are then logged as any other 4xx is, rather
+        than as a server error.
+        """
+
+        @functools.wraps(get_response)
+        def inner(request):
+            try:
+                return get_response(request)
+            except RequestTimeout:
+                return HttpResponse("408 Request Timeout (upload too slow)", status=408)
+            except RequestAborted:
+                return http.HttpResponseBadRequest()
+
+        return exception.convert_exception_to_response(inner)
+
     def load_middleware(self):
         """
         Loads the Django middleware chain and caches it on the class.
@@ -285,7 +704,7 @@ class AsgiHandler(base.BaseHandler):
             self._exception_middleware = self.__class__._exception_middleware
 
         else:
-            super(AsgiHandler, self).load_middleware()
+            self.build_middleware_chain()
             self.__class__._middleware_chain = self._middleware_chain
             self.__class__._view_middleware = self._view_middleware
             self.__class__._template_response_middleware = (
@@ -293,6 +712,47 @@ class AsgiHandler(base.BaseHandler):
             )
             self.__class__._exception_middleware = self._exception_middleware
 
+    def build_middleware_chain(self):
+        """
+        Builds the middleware chain from settings.MIDDLEWARE just as Django's
+        load_middleware() does, except that each layer's exceptions go
+        through our own convert_exception_to_response().
+        """
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._exception_middleware = []
+
+        handler = self.convert_exception_to_response(self._get_response)
+        for middleware_path in reversed(settings.MIDDLEWARE):
+            middleware = import_string(middleware_path)
+            try:
+                mw_instance = middleware(handler)
+            except MiddlewareNotUsed as exc:
+                if settings.DEBUG:
+                    if str(exc):
+                        logger.debug("MiddlewareNotUsed(%r): %s", middleware_path, exc)
+                    else:
+                        logger.debug("MiddlewareNotUsed: %r", middleware_path)
+                continue
+
+            if mw_instance is None:
+                raise ImproperlyConfigured(
+                    "Middleware factory %s returned None." % middleware_path
+                )
+
+            if hasattr(mw_instance, "process_view"):
+                self._view_middleware.insert(0, mw_instance.process_view)
+            if hasattr(mw_instance, "process_template_response"):
+                self._template_response_middleware.append(
+                    mw_instance.process_template_response
+                )
+            if hasattr(mw_instance, "process_exception"):
+                self._exception_middleware.append(mw_instance.process_exception)
+
+            handler = self.convert_exception_to_response(mw_instance)
+
+        self._middleware_chain = handler
+
     @classmethod
     def encode_response(cls, response):
         """
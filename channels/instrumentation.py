@@ -0,0 +1,125 @@
+import bisect
+import threading
+
+# Upper bounds, in seconds, of the histogram buckets; the last one catches
+# everything slower
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    float("inf"),
+)
+
+
+class Histogram:
+    """
+    Counts values into fixed buckets, along with their total and maximum.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket the given fraction (0 to 1) of
+        values fall within, or None if there are no values yet.
+        """
+        if not self.count:
+            return None
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "buckets": list(zip(self.buckets, self.counts)),
+        }
+
+
+class HistogramRecorder:
+    """
+    Default consumer recorder, keeping in-process histograms of each timing
+    per message type, and counts of the errors handlers raise.
+
+    Consumers call record() with one of these metrics:
+
+    * ``handler_time``: seconds spent handling the message
+    * ``queue_wait``: seconds a sync consumer's handler waited for a thread
+    * ``message_age``: seconds between the consumer receiving the message and
+      starting to handle it
+
+    and error() with any exception a handler raises. Any object with those
+    two methods can be used as a recorder instead. Both may be called from
+    handler threads as well as the event loop.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, metric, message_type, value):
+        with self.lock:
+            try:
+                histogram = self.histograms[metric, message_type]
+            except KeyError:
+                histogram = self.histograms[metric, message_type] = Histogram(
+                    self.buckets
+                )
+            histogram.add(value)
+
+    def error(self, message_type, exception):
+        key = (message_type, exception.__class__.__name__)
+        with self.lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def stats(self):
+        """
+        Returns a snapshot of everything recorded so far, as
+        {metric: {message type: histogram}} plus an "errors" entry of
+        {message type: {exception class name: count}}.
+        """
+        with self.lock:
+            stats = {"errors": {}}
+            for (metric, message_type), histogram in self.histograms.items():
+                stats.setdefault(metric, {})[message_type] = histogram.as_dict()
+            for (message_type, name), count in self.errors.items():
+                stats["errors"].setdefault(message_type, {})[name] = count
+            return stats
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.errors = {}
@@ -2,10 +2,13 @@ from __future__ import unicode_literals
 
 import asyncio
 import fnmatch
+import heapq
+import itertools
 import random
 import re
 import string
 import time
+from collections import deque
 from copy import deepcopy
 
 from django.conf import settings
@@ -100,10 +103,13 @@ class BaseChannelLayer:
     common functionality.
     """
 
-    def __init__(self, expiry=60, capacity=100, channel_capacity=None):
+    def __init__(
+        self, expiry=60, capacity=100, channel_capacity=None, priority_levels=3
+    ):
         self.expiry = expiry
         self.capacity = capacity
         self.channel_capacity = channel_capacity or {}
+        self.priority_levels = priority_levels
 
     def compile_capacities(self, channel_capacity):
         """
@@ -132,6 +138,32 @@ class BaseChannelLayer:
                 return capacity
         return self.capacity
 
+    def get_expiry(self, ttl=None):
+        """
+        Gets the number of seconds a message should live for; its own ttl if
+        it was sent with one, or the layer-wide expiry otherwise.
+        """
+        if ttl is None:
+            return self.expiry
+        if ttl <= 0:
+            raise ValueError("Message ttl must be a positive number of seconds")
+        return ttl
+
+    def check_priority(self, priority):
+        """
+        Raises TypeError or ValueError unless priority is one of the layer's
+        priority levels. Unlike the name checks, this is not an assertion, so
+        it still runs under python -O.
+        """
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            raise TypeError("Priority must be an integer, not {!r}.".format(priority))
+        if not 0 <= priority < self.priority_levels:
+            raise ValueError(
+                "Priority must be from 0 to {}, not {}.".format(
+                    self.priority_levels - 1, priority
+                )
+            )
+
     def match_type_and_length(self, name):
         if isinstance(name, str) and (len(name) < 100):
             return True
@@ -190,6 +222,113 @@ class BaseChannelLayer:
         else:
             return name
 
+    ### Process-aware fan-out
+
+    # Message key carrying the local parts of the recipients of a fan-out
+    # envelope (see group_send_by_process)
+    fanout_recipients_key = "__asgi_fanout__"
+
+    def group_by_process(self, channels):
+        """
+        Buckets channel names by their non-local part, so process-specific
+        channels owned by the same process end up in the same list. Normal
+        channels each get a bucket of their own.
+        """
+        processes = {}
+        for channel in channels:
+            processes.setdefault(self.non_local_name(channel), []).append(channel)
+        return processes
+
+    def make_fanout_envelope(self, process, channels, message):
+        """
+        Wraps a message up so that a single send to the process channel
+        reaches all of the given process-specific channels owned by it.
+        """
+        envelope = dict(message)
+        envelope[self.fanout_recipients_key] = [
+            channel[len(process) :] for channel in channels
+        ]
+        return envelope
+
+    def unpack_fanout_envelope(self, process, envelope):
+        """
+        Reverses make_fanout_envelope on the receiving process, returning a
+        list of (channel, message) pairs for the pump to deliver locally.
+        """
+        message = dict(envelope)
+        local_parts = message.pop(self.fanout_recipients_key)
+        return [(process + local_part, message) for local_part in local_parts]
+
+    async def group_send_by_process(self, channels, message, **kwargs):
+        """
+        Sends the message to all of the given channels, writing one envelope
+        per destination process rather than one message per channel, so
+        transport traffic scales with process count rather than group size.
+        Any keyword arguments are passed through to send().
+
+        Layers using this must deliver envelopes sent to a process channel
+        (a name ending in !) to its local recipients; see
+        unpack_fanout_envelope.
+        """
+        for process, members in self.group_by_process(channels).items():
+            try:
+                if process.endswith("!") and len(members) > 1:
+                    await self.send(
+                        process,
+                        self.make_fanout_envelope(process, members, message),
+                        **kwargs
+                    )
+                else:
+                    for channel in members:
+                        await self.send(channel, message, **kwargs)
+            except ChannelFull:
+                pass
+
+
+class ChannelQueue:
+    """
+    Messages waiting on a single channel of the in-memory layer: one FIFO
+    lane per priority level, plus the futures of receivers waiting on it.
+
+    Lanes hold [expires, message] entries; an entry whose message has been
+    set to None has expired or been received already, and is skipped.
+    """
+
+    def __init__(self, priority_levels):
+        self.lanes = [deque() for _ in range(priority_levels)]
+        self.size = 0
+        self.waiters = deque()
+
+    def put(self, entry, priority):
+        self.lanes[priority].append(entry)
+        self.size += 1
+        self.wake()
+
+    def pop(self):
+        """
+        Takes the next message from the highest non-empty lane, or returns
+        None if there are no live messages.
+        """
+        for lane in reversed(self.lanes):
+            while lane:
+                entry = lane.popleft()
+                message = entry[1]
+                if message is not None:
+                    entry[1] = None
+                    self.size -= 1
+                    return message
+        return None
+
+    def wake(self):
+        """
+        Wakes up the first receiver still waiting on the channel, if any.
+        """
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
 
 class InMemoryChannelLayer(BaseChannelLayer):
     """
@@ -211,50 +350,174 @@ class InMemoryChannelLayer(BaseChannelLayer):
             **kwargs
         )
         self.channels = {}
+        # Group -> {channel: join time}. Re-joining moves a channel to the end,
+        # so each group's dict stays in join order for expiry to walk
         self.groups = {}
         self.group_expiry = group_expiry
+        # Heap of (expires, sequence, channel, entry, evicts) over all queued
+        # messages
+        self.expiry_index = []
+        self.expiry_sequence = itertools.count()
+        self.queued = 0
 
     ### Channel layer API ###
 
-    extensions = ["groups", "flush"]
+    extensions = ["groups", "flush", "receive_any", "receive_many"]
 
-    async def send(self, channel, message):
+    async def send(self, channel, message, *, ttl=None, priority=0):
         """
         Send a message onto a (general or specific) channel.
+
+        The message expires after ttl seconds if given, or the layer's expiry
+        otherwise, and is received ahead of any messages on the channel with
+        a lower priority.
         """
         # Typecheck
         assert isinstance(message, dict), "message is not a dict"
         assert self.valid_channel_name(channel), "Channel name not valid"
+        self.check_priority(priority)
         # If it's a process-local channel, strip off local part and stick full name in message
         assert "__asgi_channel__" not in message
+        expires = time.time() + self.get_expiry(ttl)
+        # Only a message left for the layer's whole expiry marks its channel
+        # as dead; a short ttl says nothing about whether anyone is reading
+        evicts = ttl is None
+
+        # Fan-out envelopes for this process are unpacked right away; we are
+        # the only process, so this is our pump
+        if channel.endswith("!") and self.fanout_recipients_key in message:
+            self._deliver_fanout(channel, message, expires, priority, evicts)
+            return
 
-        queue = self.channels.setdefault(channel, asyncio.Queue())
         # Are we full
-        if queue.qsize() >= self.capacity:
+        queue = self.channels.get(channel)
+        if queue is not None and queue.size >= self.capacity:
             raise ChannelFull(channel)
 
         # Add message
-        await queue.put((time.time() + self.expiry, deepcopy(message)))
+        self._put(channel, deepcopy(message), expires, priority, evicts)
 
     async def receive(self, channel):
         """
-        Receive the first message that arrives on the channel.
+        Receive the first message that arrives on the channel, taking it from
+        the highest priority lane that has one.
         If more than one coroutine waits on the same channel, a random one
         of the waiting coroutines will get the result.
         """
         assert self.valid_channel_name(channel)
-        self._clean_expired()
-
-        queue = self.channels.setdefault(channel, asyncio.Queue())
+        _, message = await self.receive_any([channel])
+        return message
 
-        # Do a plain direct receive
-        _, message = await queue.get()
+    async def receive_any(self, channels, timeout=None):
+        """
+        Receive the first message that arrives on any of the given channels,
+        returning a (channel, message) tuple. One waiter is shared by all the
+        channels, and they are checked starting from a random one so that a
+        busy channel cannot starve the others.
+        Raises asyncio.TimeoutError if nothing arrives within timeout seconds.
+        """
+        channels = list(channels)
+        if not channels:
+            raise ValueError("receive_any() needs at least one channel")
+        assert self.valid_channel_names(channels)
+        self._clean_expired()
 
-        # Delete if empty
-        if queue.empty():
+        queues = [(channel, self._get_queue(channel)) for channel in channels]
+        start = random.randrange(len(queues))
+        queues = queues[start:] + queues[:start]
+        loop = asyncio.get_event_loop()
+        if timeout is not None:
+            deadline = loop.time() + timeout
+        try:
+            while True:
+                for channel, queue in queues:
+                    message = queue.pop()
+                    if message is not None:
+                        self.queued -= 1
+                        return channel, message
+                # Nothing there; wait until a send to any of them wakes us
+                waiter = loop.create_future()
+                for _, queue in queues:
+                    queue.waiters.append(waiter)
+                try:
+                    if timeout is None:
+                        await waiter
+                    else:
+                        await asyncio.wait_for(waiter, deadline - loop.time())
+                finally:
+                    for _, queue in queues:
+                        if waiter in queue.waiters:
+                            queue.waiters.remove(waiter)
+        finally:
+            for channel, queue in queues:
+                # Pass on any wakeup we were given but didn't use
+                if queue.size:
+                    queue.wake()
+                self._release_queue(channel, queue)
+
+    async def receive_many(self, channels, max_messages, timeout=None):
+        """
+        Receives up to max_messages messages from any of the channels,
+        waiting as receive_any() does until there is at least one, and returns
+        them as a list of (channel, message) tuples. Messages are taken from
+        the channels in turn, so each keeps its own order.
+        """
+        received = [await self.receive_any(channels, timeout=timeout)]
+        queues = [
+            (channel, self.channels[channel])
+            for channel in channels
+            if channel in self.channels
+        ]
+        while queues and len(received) < max_messages:
+            for channel, queue in list(queues):
+                message = queue.pop()
+                if message is None:
+                    queues.remove((channel, queue))
+                    self._release_queue(channel, queue)
+                    continue
+                self.queued -= 1
+                received.append((channel, message))
+                if len(received) >= max_messages:
+                    break
+        for channel, queue in queues:
+            self._release_queue(channel, queue)
+        return received
+
+    def _get_queue(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = ChannelQueue(self.priority_levels)
+        return queue
+
+    def _release_queue(self, channel, queue):
+        """
+        Deletes a channel's queue once it has no messages and no receivers.
+        """
+        if not queue.size and not queue.waiters and self.channels.get(channel) is queue:
             del self.channels[channel]
 
-        return message
+    def _put(self, channel, message, expires, priority, evicts):
+        """
+        Queues a message on a channel and adds it to the expiry index, noting
+        whether its expiring should remove the channel from its groups.
+        """
+        entry = [expires, message]
+        heapq.heappush(
+            self.expiry_index,
+            (expires, next(self.expiry_sequence), channel, entry, evicts),
+        )
+        self.queued += 1
+        self._get_queue(channel).put(entry, priority)
+
+    def _deliver_fanout(self, process, envelope, expires, priority, evicts):
+        """
+        Delivers a fan-out envelope to each of its local recipients, silently
+        dropping it for any that are full as group sends do.
+        """
+        for channel, message in self.unpack_fanout_envelope(process, envelope):
+            queue = self.channels.get(channel)
+            if queue is None or queue.size < self.capacity:
+                self._put(channel, deepcopy(message), expires, priority, evicts)
 
     async def new_channel(self, prefix="specific."):
         """
@@ -270,40 +533,54 @@ class InMemoryChannelLayer(BaseChannelLayer):
 
     def _clean_expired(self):
         """
-        Goes through all messages and groups and removes those that are expired.
-        Any channel with an expired message is removed from all groups.
-        """
-        # Channel cleanup
-        for channel, queue in list(self.channels.items()):
-            remove = False
-            # See if it's expired
-            while not queue.empty() and queue._queue[0][0] < time.time():
-                queue.get_nowait()
-                remove = True
-            # Any removal prompts group discard
-            if remove:
+        Removes expired messages, as found by the expiry index, and expired
+        group memberships. Any channel with a message that went unreceived
+        for the layer's whole expiry is removed from all groups.
+        """
+        # Channel cleanup, in order of each message's own deadline
+        now = time.time()
+        expiry_index = self.expiry_index
+        while expiry_index and expiry_index[0][0] < now:
+            _, _, channel, entry, evicts = heapq.heappop(expiry_index)
+            # Already received?
+            if entry[1] is None:
+                continue
+            entry[1] = None
+            self.queued -= 1
+            queue = self.channels[channel]
+            queue.size -= 1
+            self._release_queue(channel, queue)
+            # Its consumer has gone away, so it leaves its groups
+            if evicts:
                 self._remove_from_groups(channel)
-            # Is the channel now empty and needs deleting?
-            if not queue:
-                del self.channels[channel]
-
-        # Group Expiration
-        timeout = int(time.time()) - self.group_expiry
-        for group in self.groups:
-            for channel in list(self.groups.get(group, set())):
-                # If join time is older than group_expiry end the group membership
-                if (
-                    self.groups[group][channel]
-                    and int(self.groups[group][channel]) < timeout
-                ):
-                    # Delete from group
-                    del self.groups[group][channel]
+        # Drop received messages from the index once they dominate it
+        if len(expiry_index) > 2 * self.queued + 100:
+            self.expiry_index = [
+                item for item in expiry_index if item[3][1] is not None
+            ]
+            heapq.heapify(self.expiry_index)
+
+        # Group Expiration; each group is in join order, so stop at the first
+        # member that hasn't expired
+        cutoff = time.time() - self.group_expiry
+        for group, members in list(self.groups.items()):
+            expired = []
+            for channel, joined in members.items():
+                if joined >= cutoff:
+                    break
+                expired.append(channel)
+            for channel in expired:
+                del members[channel]
+            if not members:
+                del self.groups[group]
 
     ### Flush extension ###
 
     async def flush(self):
         self.channels = {}
         self.groups = {}
+        self.expiry_index = []
+        self.queued = 0
 
     async def close(self):
         # Nothing to go
@@ -311,11 +588,12 @@ class InMemoryChannelLayer(BaseChannelLayer):
 
     def _remove_from_groups(self, channel):
         """
-        Removes a channel from all groups. Used when a message on it expires.
+        Removes a channel from all groups. Used when a message on it expires
+        unreceived.
         """
-        for channels in self.groups.values():
-            if channel in channels:
-                del channels[channel]
+        for group, channels in list(self.groups.items()):
+            if channels.pop(channel, None) is not None and not channels:
+                del self.groups[group]
 
     ### Groups extension ###
 
@@ -326,33 +604,33 @@ class InMemoryChannelLayer(BaseChannelLayer):
         # Check the inputs
         assert self.valid_group_name(group), "Group name not valid"
         assert self.valid_channel_name(channel), "Channel name not valid"
-        # Add to group dict
-        self.groups.setdefault(group, {})
-        self.groups[group][channel] = time.time()
+        # Add to group dict, moving it to the end if it is already in there
+        members = self.groups.setdefault(group, {})
+        members.pop(channel, None)
+        members[channel] = time.time()
 
     async def group_discard(self, group, channel):
         # Both should be text and valid
         assert self.valid_channel_name(channel), "Invalid channel name"
         assert self.valid_group_name(group), "Invalid group name"
-        # Remove from group set
+        # Remove from group dict
         if group in self.groups:
-            if channel in self.groups[group]:
-                del self.groups[group][channel]
+            self.groups[group].pop(channel, None)
             if not self.groups[group]:
                 del self.groups[group]
 
-    async def group_send(self, group, message):
+    async def group_send(self, group, message, *, ttl=None, priority=0):
         # Check types
         assert isinstance(message, dict), "Message is not a dict"
         assert self.valid_group_name(group), "Invalid group name"
+        self.check_priority(priority)
+        self.get_expiry(ttl)
         # Run clean
         self._clean_expired()
-        # Send to each channel
-        for channel in self.groups.get(group, set()):
-            try:
-                await self.send(channel, message)
-            except ChannelFull:
-                pass
+        # Send to each channel, one envelope per process
+        await self.group_send_by_process(
+            list(self.groups.get(group, ())), message, ttl=ttl, priority=priority
+        )
 
 
 def get_channel_layer(alias=DEFAULT_CHANNEL_LAYER):
@@ -0,0 +1,98 @@
+import asyncio
+import importlib.util
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger("django.channels")
+
+# Event loop names and the policies that provide them; any other name is
+# taken as the dotted path of a policy class
+LOOP_POLICIES = {
+    "asyncio": "asyncio.DefaultEventLoopPolicy",
+    "uvloop": "uvloop.EventLoopPolicy",
+}
+
+
+def get_loop_options(loop=None, executor_workers=None, task_factory=None):
+    """
+    Returns a dict of event loop options, taking any given here over those
+    in the CHANNELS_EVENT_LOOP setting.
+    """
+    options = {"loop": None, "executor_workers": None, "task_factory": None}
+    options.update(getattr(settings, "CHANNELS_EVENT_LOOP", {}))
+    for name, value in [
+        ("loop", loop),
+        ("executor_workers", executor_workers),
+        ("task_factory", task_factory),
+    ]:
+        if value is not None:
+            options[name] = value
+    return options
+
+
+def resolve_loop_name(name):
+    """
+    Returns the loop that asking for the named one gets: "uvloop" falls back
+    to "asyncio" if uvloop isn't installed.
+    """
+    if name == "uvloop" and importlib.util.find_spec("uvloop") is None:
+        logger.warning("uvloop is not installed; using the asyncio event loop")
+        return "asyncio"
+    return name
+
+
+def get_loop_policy_class(name):
+    """
+    Returns the event loop policy class for the named loop.
+    """
+    try:
+        return import_string(LOOP_POLICIES.get(name, name))
+    except ImportError as e:
+        raise ImproperlyConfigured("Cannot import event loop policy %r: %s" % (name, e))
+
+
+def install_loop_policy(name):
+    """
+    Sets the event loop policy for the named loop, so loops made from now on
+    are of that kind, and returns the name of the loop actually used. Does
+    nothing if name is None.
+    """
+    if name is None:
+        return None
+    name = resolve_loop_name(name)
+    asyncio.set_event_loop_policy(get_loop_policy_class(name)())
+    return name
+
+
+def configure_loop(loop, executor_workers=None, task_factory=None):
+    """
+    Gives a loop a default executor with the given number of threads, and
+    the task factory (a callable, or its dotted path), if they are set.
+    """
+    if executor_workers:
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=executor_workers))
+    if task_factory:
+        if isinstance(task_factory, str):
+            task_factory = import_string(task_factory)
+        loop.set_task_factory(task_factory)
+
+
+def describe_loop(loop):
+    """
+    Returns the dotted path of a loop's class, for logging which is in use.
+    """
+    return "%s.%s" % (loop.__class__.__module__, loop.__class__.__qualname__)
+
+
+def loop_matches(loop, name):
+    """
+    Returns whether a loop is of the kind the named policy makes.
+    """
+    policy = get_loop_policy_class(resolve_loop_name(name))()
+    other_loop = policy.new_event_loop()
+    other_loop.close()
+    return loop.__class__ is other_loop.__class__
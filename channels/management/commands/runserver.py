@@ -8,6 +8,7 @@ from django.core.management import CommandError
 from django.core.management.commands.runserver import Command as RunserverCommand
 
 from channels import __version__
+from channels.loops import configure_loop, describe_loop, get_loop_options, loop_matches
 from channels.routing import get_default_application
 from daphne.endpoints import build_endpoint_description_strings
 from daphne.server import Server
@@ -46,6 +47,28 @@ class Command(RunserverCommand):
             default=5,
             help="Specify the daphne websocket_handshake_timeout interval in seconds (default: 5)",
         )
+        parser.add_argument(
+            "--loop",
+            action="store",
+            dest="loop",
+            default=None,
+            help="Event loop to check for: asyncio, uvloop or a policy class path",
+        )
+        parser.add_argument(
+            "--executor-workers",
+            action="store",
+            dest="executor_workers",
+            type=int,
+            default=None,
+            help="Number of threads in the event loop's default executor",
+        )
+        parser.add_argument(
+            "--task-factory",
+            action="store",
+            dest="task_factory",
+            default=None,
+            help="Dotted path of a task factory for the event loop",
+        )
 
     def handle(self, *args, **options):
         self.http_timeout = options.get("http_timeout", None)
@@ -55,6 +78,22 @@ class Command(RunserverCommand):
             raise CommandError(
                 "You have not set ASGI_APPLICATION, which is needed to run the server."
             )
+        self.loop_options = get_loop_options(
+            options.get("loop"),
+            options.get("executor_workers"),
+            options.get("task_factory"),
+        )
+        # Daphne's event loop is made when Channels is loaded, before we get
+        # here, so it can only be chosen with the setting
+        loop = self.get_event_loop()
+        if self.loop_options["loop"] and not loop_matches(
+            loop, self.loop_options["loop"]
+        ):
+            raise CommandError(
+                "The server's event loop is %s, not %s. It is made as Channels "
+                "loads, so choose it with the CHANNELS_EVENT_LOOP setting."
+                % (describe_loop(loop), self.loop_options["loop"])
+            )
         # Dispatch upward
         super().handle(*args, **options)
 
@@ -90,6 +129,14 @@ class Command(RunserverCommand):
             }
         )
 
+        loop = self.get_event_loop()
+        configure_loop(
+            loop,
+            self.loop_options["executor_workers"],
+            self.loop_options["task_factory"],
+        )
+        self.stdout.write("Using event loop %s\n" % describe_loop(loop))
+
         # Launch server in 'main' thread. Signals are disabled as it's still
         # actually a subthread under the autoreloader.
         logger.debug("Daphne running, listening on %s:%s", self.addr, self.port)
@@ -113,6 +160,15 @@ class Command(RunserverCommand):
                 self.stdout.write(shutdown_message)
             return
 
+    def get_event_loop(self):
+        """
+        Returns the event loop Daphne's Twisted reactor runs on.
+        """
+        # Imported here, after daphne.server has installed the reactor
+        from twisted.internet import reactor
+
+        return reactor._asyncioEventloop
+
     def get_application(self, options):
         """
         Returns the static files serving application wrapping the default application,
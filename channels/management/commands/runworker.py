@@ -1,11 +1,15 @@
+import asyncio
 import logging
 
 from django.core.management import BaseCommand, CommandError
 
 from channels import DEFAULT_CHANNEL_LAYER
-from channels.layers import get_channel_layer
+from channels.beat import Beat
+from channels.layers import channel_layers, get_channel_layer
+from channels.loops import get_loop_options, install_loop_policy
 from channels.routing import get_default_application
-from channels.worker import Worker
+from channels.supervisor import Supervisor
+from channels.worker import AdaptiveLimiter, Worker
 
 logger = logging.getLogger("django.channels.worker")
 
@@ -24,11 +28,111 @@ class Command(BaseCommand):
             default=DEFAULT_CHANNEL_LAYER,
             help="Channel layer alias to use, if not the default.",
         )
+        parser.add_argument(
+            "--prefetch",
+            action="store",
+            dest="prefetch",
+            type=int,
+            default=1,
+            help="Most messages to fetch per channel layer call, if supported.",
+        )
+        parser.add_argument(
+            "--max-in-flight",
+            action="store",
+            dest="max_in_flight",
+            type=int,
+            default=None,
+            help="Most messages to queue up for each channel's application.",
+        )
+        parser.add_argument(
+            "--partitions",
+            action="store",
+            dest="partitions",
+            type=int,
+            default=1,
+            help="Number of application instances to spread each channel over.",
+        )
+        parser.add_argument(
+            "--partition-key",
+            action="store",
+            dest="partition_key",
+            default="key",
+            help="Message field to partition messages by.",
+        )
+        parser.add_argument(
+            "--processes",
+            action="store",
+            dest="processes",
+            type=int,
+            default=1,
+            help="Number of worker processes to run under a supervisor.",
+        )
+        parser.add_argument(
+            "--pin-cpus",
+            action="store_true",
+            dest="pin_cpus",
+            default=False,
+            help="Pin each worker process to its own CPU.",
+        )
+        parser.add_argument(
+            "--beat",
+            action="store_true",
+            dest="beat",
+            default=False,
+            help="Send the scheduled messages in CHANNELS_BEAT.",
+        )
+        parser.add_argument(
+            "--stats-interval",
+            action="store",
+            dest="stats_interval",
+            type=float,
+            default=None,
+            help="Seconds between logging worker stats; off by default.",
+        )
+        parser.add_argument(
+            "--target-latency",
+            action="store",
+            dest="target_latency",
+            type=float,
+            default=None,
+            help="Seconds messages may wait for a consumer before the worker "
+            "takes fewer; off by default.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store",
+            dest="loop",
+            default=None,
+            help="Event loop to use: asyncio, uvloop or a policy class path.",
+        )
+        parser.add_argument(
+            "--executor-workers",
+            action="store",
+            dest="executor_workers",
+            type=int,
+            default=None,
+            help="Number of threads in the event loop's default executor.",
+        )
+        parser.add_argument(
+            "--task-factory",
+            action="store",
+            dest="task_factory",
+            default=None,
+            help="Dotted path of a task factory for the event loop.",
+        )
         parser.add_argument("channels", nargs="+", help="Channels to listen on.")
 
     def handle(self, *args, **options):
         # Get the backend to use
         self.verbosity = options.get("verbosity", 1)
+        # Channels loading installed any event loop from the setting; change
+        # it if asked, before anything makes one
+        install_loop_policy(options.get("loop"))
+        self.loop_options = get_loop_options(
+            options.get("loop"),
+            options.get("executor_workers"),
+            options.get("task_factory"),
+        )
         # Get the channel layer they asked for (or see if one isn't configured)
         if "layer" in options:
             self.channel_layer = get_channel_layer(options["layer"])
@@ -36,11 +140,59 @@ class Command(BaseCommand):
             self.channel_layer = get_channel_layer()
         if self.channel_layer is None:
             raise CommandError("You do not have any CHANNEL_LAYERS configured.")
-        # Run the worker
-        logger.info("Running worker for channels %s", options["channels"])
+        # Import the application before forking, so processes share it
+        self.application = get_default_application()
+        self.options = options
+        processes = options.get("processes", 1)
+        if processes > 1:
+            logger.info(
+                "Running %s worker processes for channels %s",
+                processes,
+                options["channels"],
+            )
+            Supervisor(
+                self.run_worker_process, processes, options.get("pin_cpus", False)
+            ).run()
+        else:
+            logger.info("Running worker for channels %s", options["channels"])
+            self.run_worker()
+
+    def run_worker_process(self, index):
+        """
+        Runs a worker in a supervised child process, with its own event loop
+        and channel layer rather than the ones it inherited from the parent.
+        """
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        channel_layers.backends = {}
+        self.channel_layer = get_channel_layer(
+            self.options.get("layer", DEFAULT_CHANNEL_LAYER)
+        )
+        # Only the first process sends scheduled messages, so they go once
+        self.run_worker(beat=index == 0)
+
+    def run_worker(self, beat=True):
+        options = self.options
+        if beat and options.get("beat", False):
+            beat = Beat.from_settings(options["channels"]) or None
+        else:
+            beat = None
+        target_latency = options.get("target_latency")
+        if target_latency:
+            limiter = AdaptiveLimiter(target_latency)
+        else:
+            limiter = None
         worker = self.worker_class(
-            application=get_default_application(),
+            application=self.application,
             channels=options["channels"],
             channel_layer=self.channel_layer,
+            prefetch=options.get("prefetch", 1),
+            max_in_flight=options.get("max_in_flight"),
+            partitions=options.get("partitions", 1),
+            partition_key=options.get("partition_key", "key"),
+            beat=beat,
+            stats_interval=options.get("stats_interval"),
+            limiter=limiter,
+            executor_workers=self.loop_options["executor_workers"],
+            task_factory=self.loop_options["task_factory"],
         )
         worker.run()
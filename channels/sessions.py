@@ -11,7 +11,10 @@ from django.utils import timezone
 from django.utils.encoding import force_str
 from django.utils.functional import LazyObject
 
-from channels.db import database_sync_to_async
+from channels.db import (
+    database_sync_to_async,
+    maybe_coalesced_database_sync_to_async,
+)
 
 try:
     from django.utils.http import http_date
@@ -175,7 +178,7 @@ class SessionMiddlewareInstance:
         """
         # Resolve the session now we can do it in a blocking way
         session_key = self.scope["cookies"].get(self.middleware.cookie_name)
-        self.scope["session"]._wrapped = await database_sync_to_async(
+        self.scope["session"]._wrapped = await maybe_coalesced_database_sync_to_async(
             self.middleware.session_store
         )(session_key)
         # Override send
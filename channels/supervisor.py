@@ -0,0 +1,176 @@
+import logging
+import os
+import signal
+import time
+import traceback
+
+from django.db import connections
+
+from asgiref.sync import async_to_sync
+
+from .layers import channel_layers
+
+logger = logging.getLogger("django.channels.worker")
+
+
+class Supervisor:
+    """
+    Runs a target callable in several forked child processes, passing each
+    its index. Children that exit are started again, waiting longer after
+    each crash in a row. SIGTERM and SIGINT are passed on to the children as
+    SIGTERM, and the supervisor returns once they have all exited. Children
+    ignore SIGINT themselves, as a Ctrl-C in a terminal sends it to the
+    whole process group; they stop on the SIGTERM passed on instead.
+
+    Children are forked once everything is imported and set up, so they
+    share the parent's memory copy-on-write. Database and channel layer
+    connections are closed before each fork, so children don't share their
+    sockets. Needs os.fork(), so POSIX only.
+    """
+
+    # Seconds to wait before restarting a crashed child; doubles each time
+    # it crashes again before running for stable_after seconds
+    min_backoff = 0.5
+    max_backoff = 30
+    stable_after = 30
+
+    # Seconds between checks for exited children
+    poll_interval = 0.1
+
+    def __init__(self, target, processes, pin_cpus=False):
+        self.target = target
+        self.processes = processes
+        self.pin_cpus = pin_cpus
+        # Child pid -> (index, start time)
+        self.children = {}
+        # Index -> time it is due to be restarted
+        self.restarts = {}
+        # Index -> seconds waited before its last restart
+        self.backoffs = {}
+        self.stopping = False
+
+    def run(self):
+        """
+        Starts the children and looks after them until told to stop.
+        """
+        previous_handlers = {
+            signum: signal.signal(signum, self.handle_signal)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            for index in range(self.processes):
+                self.spawn(index)
+            while self.children or (self.restarts and not self.stopping):
+                self.reap()
+                self.restart_due()
+                time.sleep(self.poll_interval)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+    def handle_signal(self, signum, frame):
+        """
+        Passes a stop signal on to the children, so they can drain.
+        """
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def spawn(self, index):
+        """
+        Forks a child to run the target.
+        """
+        self.close_connections()
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (index, time.monotonic())
+            return pid
+        # In the child from here on; never return into the parent's code
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            if self.pin_cpus:
+                self.pin_cpu(index)
+            self.target(index)
+            code = 0
+        except SystemExit as exception:
+            code = exception.code if isinstance(exception.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+
+    def close_connections(self):
+        """
+        Closes this process's database connections and channel layers, which
+        would otherwise be inherited, sockets and all, by the next child.
+        """
+        connections.close_all()
+        for layer in channel_layers.backends.values():
+            # Layers with connection pools (such as channels_redis) can close
+            # them; the rest need nothing doing
+            close_pools = getattr(layer, "close_pools", None)
+            if close_pools is not None:
+                async_to_sync(close_pools)()
+        channel_layers.backends = {}
+
+    def pin_cpu(self, index):
+        """
+        Pins the current process to one of the CPUs it may run on, if the
+        platform allows it.
+        """
+        if not hasattr(os, "sched_setaffinity"):
+            return
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+
+    def reap(self):
+        """
+        Collects exited children, scheduling restarts unless we're stopping.
+        """
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if not pid:
+                return
+            if pid not in self.children:
+                continue
+            index, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+            if time.monotonic() - started >= self.stable_after:
+                backoff = self.min_backoff
+            elif index in self.backoffs:
+                backoff = min(self.backoffs[index] * 2, self.max_backoff)
+            else:
+                backoff = self.min_backoff
+            self.backoffs[index] = backoff
+            self.restarts[index] = time.monotonic() + backoff
+            if os.WIFSIGNALED(status):
+                reason = "was killed by signal %s" % os.WTERMSIG(status)
+            else:
+                reason = "exited with status %s" % os.WEXITSTATUS(status)
+            logger.warning(
+                "Worker process %s (pid %s) %s; restarting in %.1fs",
+                index,
+                pid,
+                reason,
+                backoff,
+            )
+
+    def restart_due(self):
+        """
+        Starts any children whose backoff has run out.
+        """
+        now = time.monotonic()
+        for index, due in list(self.restarts.items()):
+            if due <= now and not self.stopping:
+                del self.restarts[index]
+                self.spawn(index)
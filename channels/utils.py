@@ -1,4 +1,6 @@
 import asyncio
+import functools
+import threading
 import types
 
 
@@ -29,32 +31,289 @@ def name_that_thing(thing):
     return repr(thing)
 
 
-async def await_many_dispatch(consumer_callables, dispatch):
+class ReaderFailure:
+    """
+    Stands in for a result when a consumer callable raised, so the error
+    reaches the dispatch loop in order.
+    """
+
+    __slots__ = ("exception",)
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class ResultSlot:
+    """
+    Hands single results from reader tasks over to the dispatch loop. Works
+    like asyncio.Queue(maxsize=1), but without the several deques and the
+    event that every queue allocates, as there is one of these per open
+    connection.
+    """
+
+    __slots__ = ("loop", "full", "result", "getter", "putters")
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.full = False
+        self.result = None
+        self.getter = None
+        # Futures of readers waiting for the slot to empty, once there are any
+        self.putters = None
+
+    def empty(self):
+        return not self.full
+
+    async def put(self, result):
+        while self.full:
+            putter = self.loop.create_future()
+            if self.putters is None:
+                self.putters = []
+            self.putters.append(putter)
+            try:
+                await putter
+            except BaseException:
+                if putter.done() and not putter.cancelled():
+                    # We were woken but can't take the slot; pass it on
+                    self.wake_putter()
+                elif putter in self.putters:
+                    self.putters.remove(putter)
+                raise
+        self.full = True
+        self.result = result
+        if self.getter is not None and not self.getter.done():
+            self.getter.set_result(None)
+
+    async def get(self):
+        while not self.full:
+            self.getter = self.loop.create_future()
+            try:
+                await self.getter
+            finally:
+                self.getter = None
+        return self.get_nowait()
+
+    def get_nowait(self):
+        if not self.full:
+            raise asyncio.QueueEmpty()
+        result, self.result = self.result, None
+        self.full = False
+        self.wake_putter()
+        return result
+
+    def wake_putter(self):
+        while self.putters:
+            putter = self.putters.pop(0)
+            if not putter.done():
+                putter.set_result(None)
+                return
+
+
+async def read_forever(consumer_callable, results):
+    """
+    Calls a consumer callable in a loop, pushing each result onto the results
+    queue.
     """
-    Given a set of consumer callables, awaits on them all and passes results
-    from them to the dispatch awaitable as they come in.
-    """
-    # Start them all off as tasks
-    loop = asyncio.get_event_loop()
-    tasks = [
-        loop.create_task(consumer_callable())
-        for consumer_callable in consumer_callables
-    ]
     try:
         while True:
-            # Wait for any of them to complete
-            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-            # Find the completed one(s), yield results, and replace them
-            for i, task in enumerate(tasks):
-                if task.done():
-                    result = task.result()
-                    await dispatch(result)
-                    tasks[i] = asyncio.ensure_future(consumer_callables[i]())
-    finally:
-        # Make sure we clean up tasks on exit
-        for task in tasks:
-            task.cancel()
-            try:
-                await task
-            except asyncio.CancelledError:
-                pass
+            await results.put(await consumer_callable())
+    except Exception as exception:
+        await results.put(ReaderFailure(exception))
+
+
+class DispatchLoop:
+    """
+    Reads results from a set of consumer callables and passes them to the
+    dispatch awaitable as they come in.
+
+    Each callable gets one long-lived reader task for the whole run, feeding
+    a single ResultSlot that is drained into dispatch, so readers can't run
+    more than a result ahead of dispatch. More callables can be added with
+    add() at any point, from any thread.
+
+    With max_concurrency above one, each result is dispatched in a task of
+    its own, with at most max_concurrency of them in flight. Results that
+    ordering_key maps to the same key (other than None) are still dispatched
+    one after the other, in the order they came in. The first error from any
+    dispatch stops the loop and cancels the rest.
+
+    If batch_key is given, results it maps to a key (other than None) are
+    collected together with the results that follow them under the same key,
+    up to batch_size of them or for at most batch_timeout seconds, and the
+    list is passed to dispatch_batch instead.
+    """
+
+    __slots__ = (
+        "dispatch",
+        "max_concurrency",
+        "ordering_key",
+        "batch_key",
+        "dispatch_batch",
+        "batch_size",
+        "batch_timeout",
+        "loop",
+        "thread_id",
+        "results",
+        "held",
+        "readers",
+        "slots",
+        "tails",
+        "handlers",
+        "failures",
+    )
+
+    def __init__(
+        self,
+        dispatch,
+        max_concurrency=1,
+        ordering_key=None,
+        batch_key=None,
+        dispatch_batch=None,
+        batch_size=100,
+        batch_timeout=0.01,
+    ):
+        self.dispatch = dispatch
+        self.max_concurrency = max_concurrency
+        self.ordering_key = ordering_key
+        self.batch_key = batch_key
+        self.dispatch_batch = dispatch_batch
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.loop = asyncio.get_event_loop()
+        self.thread_id = threading.get_ident()
+        self.results = ResultSlot(self.loop)
+        # A result read while collecting a batch that doesn't belong in it
+        self.held = None
+        self.readers = []
+        # State for concurrent dispatch, only made if it's needed
+        if max_concurrency > 1:
+            self.slots = asyncio.Semaphore(max_concurrency)
+            self.tails = {}
+            self.handlers = set()
+            self.failures = []
+        else:
+            self.slots = self.tails = self.handlers = self.failures = None
+
+    def add(self, consumer_callable):
+        """
+        Starts a reader for another consumer callable.
+        """
+        if threading.get_ident() != self.thread_id:
+            self.loop.call_soon_threadsafe(self.add, consumer_callable)
+            return
+        self.readers.append(
+            self.loop.create_task(read_forever(consumer_callable, self.results))
+        )
+
+    async def run(self):
+        """
+        Dispatches results until a callable or a dispatch raises.
+        """
+        try:
+            while True:
+                if self.held is not None:
+                    result, self.held = self.held, None
+                else:
+                    result = await self.results.get()
+                if self.failures:
+                    raise self.failures[0]
+                if isinstance(result, ReaderFailure):
+                    raise result.exception
+                dispatch, argument = self.dispatch, result
+                if self.batch_key is not None:
+                    batch_key = self.batch_key(result)
+                    if batch_key is not None:
+                        dispatch = self.dispatch_batch
+                        argument = await self.collect_batch(batch_key, result)
+                if self.max_concurrency <= 1:
+                    await dispatch(argument)
+                    continue
+                await self.slots.acquire()
+                if self.failures:
+                    raise self.failures[0]
+                if self.ordering_key is not None:
+                    key = self.ordering_key(result)
+                else:
+                    key = None
+                handler = self.loop.create_task(
+                    self.dispatch_after(
+                        dispatch,
+                        argument,
+                        None if key is None else self.tails.get(key),
+                    )
+                )
+                self.handlers.add(handler)
+                if key is not None:
+                    self.tails[key] = handler
+                handler.add_done_callback(functools.partial(self.handler_done, key))
+        finally:
+            # Make sure we clean up readers and handlers on exit
+            for task in self.readers + list(self.handlers or ()):
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+    async def collect_batch(self, key, result):
+        """
+        Returns a batch of results with the given batch key, starting with
+        result and taking those that follow it until the batch is full, the
+        timeout passes or a result with another key comes in.
+        """
+        batch = [result]
+        deadline = self.loop.time() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            if self.results.empty():
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    result = await asyncio.wait_for(self.results.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                result = self.results.get_nowait()
+            if isinstance(result, ReaderFailure) or self.batch_key(result) != key:
+                self.held = result
+                break
+            batch.append(result)
+        return batch
+
+    async def dispatch_after(self, dispatch, argument, previous):
+        """
+        Dispatches a result (or batch) once the previous one with its key is
+        done.
+        """
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await dispatch(argument)
+        except Exception as exception:
+            self.slots.release()
+            self.failures.append(exception)
+            # Wake the dispatch loop up so it sees the failure
+            await self.results.put(ReaderFailure(exception))
+        except BaseException:
+            self.slots.release()
+            raise
+        else:
+            self.slots.release()
+
+    def handler_done(self, key, handler):
+        self.handlers.discard(handler)
+        if self.tails.get(key) is handler:
+            del self.tails[key]
+
+
+async def await_many_dispatch(
+    consumer_callables, dispatch, max_concurrency=1, ordering_key=None
+):
+    """
+    Given a set of consumer callables, awaits on them all and passes results
+    from them to the dispatch awaitable as they come in; see DispatchLoop.
+    """
+    dispatch_loop = DispatchLoop(dispatch, max_concurrency, ordering_key)
+    for consumer_callable in consumer_callables:
+        dispatch_loop.add(consumer_callable)
+    await dispatch_loop.run()
@@ -1,44 +1,571 @@
 import asyncio
+import collections
+import functools
+import json
+import logging
+import signal
+import time
+import zlib
 
+from asgiref.compatibility import guarantee_single_callable
 from asgiref.server import StatelessServer
 
+from .instrumentation import Histogram
+from .loops import configure_loop, describe_loop
+
+logger = logging.getLogger("django.channels.worker")
+
+
+class AdaptiveLimiter:
+    """
+    Limits how many messages a worker holds for its application instances
+    (taken off the channel layer but not yet picked up), adjusting the limit
+    with additive increase and multiplicative decrease.
+
+    Each message picked up within target_latency of being taken raises the
+    limit a little, by about one for every limit's worth of messages. A
+    message that waited longer cuts it by backoff, at most once for the
+    messages taken before the last cut, so one slow spell only counts once.
+    """
+
+    def __init__(
+        self,
+        target_latency=0.1,
+        min_limit=1,
+        max_limit=1000,
+        initial_limit=10,
+        backoff=0.5,
+    ):
+        self.target_latency = target_latency
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial_limit)
+        self.backoff = backoff
+        self.in_flight = 0
+        self.last_cut = float("-inf")
+        self.room = None
+        self.throttled = 0
+
+    async def acquire(self):
+        """
+        Waits until there is room under the limit, and returns how many
+        messages there is room for.
+        """
+        if self.in_flight >= int(self.limit):
+            self.throttled += 1
+        while self.in_flight >= int(self.limit):
+            if self.room is None or self.room.done():
+                self.room = asyncio.get_event_loop().create_future()
+            await self.room
+        return int(self.limit) - self.in_flight
+
+    def started(self):
+        """
+        Counts a message passed to an application instance.
+        """
+        self.in_flight += 1
+
+    def done(self, queued_at):
+        """
+        Counts a message picked up, adjusting the limit by how long it waited
+        since queued_at (a time.monotonic() value).
+        """
+        now = time.monotonic()
+        if now - queued_at > self.target_latency:
+            if queued_at > self.last_cut:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_cut = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self.release(1)
+
+    def release(self, count):
+        """
+        Stops counting messages that won't be picked up, or have been.
+        """
+        self.in_flight -= count
+        if (
+            self.room is not None
+            and not self.room.done()
+            and self.in_flight < int(self.limit)
+        ):
+            self.room.set_result(None)
+
+    def stats(self):
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "throttled": self.throttled,
+        }
+
 
 class Worker(StatelessServer):
     """
     ASGI protocol server that surfaces events sent to specific channels
     on the channel layer into a single application instance.
+
+    With prefetch above one, listeners pull up to that many messages per
+    channel layer call, if the layer supports receive_many. With
+    max_in_flight set, each application instance queues at most that many
+    messages. Messages for a full instance are parked until it has room, and
+    listeners stop taking messages from its channel meanwhile, while still
+    taking them from the rest.
+
+    With partitions above one, each channel gets that many application
+    instances, and messages are spread between them by a hash of their
+    partition_key field. Messages with the same key stay in order; those
+    without one all go to the first partition.
+
+    On SIGTERM (or a call to stop()), the worker stops taking messages from
+    the channel layer and waits up to drain_timeout seconds for application
+    instances to take the messages already passed to them before exiting.
+
+    With a beat (see channels.beat), the worker also passes scheduled
+    messages to its channels' application instances as they come due.
+
+    The worker keeps counts of the messages it handles, which stats()
+    returns; with stats_interval set, it also logs them that often.
+
+    With a limiter (an AdaptiveLimiter), listeners only take messages off
+    the channel layer while the number held for application instances is
+    under its limit, which shrinks as they fall behind.
+
+    executor_workers and task_factory set up the event loop the worker runs
+    on (see channels.loops.configure_loop).
     """
 
-    def __init__(self, application, channels, channel_layer, max_applications=1000):
-        super().__init__(application, max_applications)
+    def __init__(
+        self,
+        application,
+        channels,
+        channel_layer,
+        max_applications=1000,
+        prefetch=1,
+        max_in_flight=None,
+        partitions=1,
+        partition_key="key",
+        drain_timeout=10,
+        beat=None,
+        stats_interval=None,
+        limiter=None,
+        executor_workers=None,
+        task_factory=None,
+    ):
+        super().__init__(self.wrap_application(application), max_applications)
         self.channels = channels
         self.channel_layer = channel_layer
         if self.channel_layer is None:
             raise ValueError("Channel layer is not valid")
+        self.prefetch = prefetch
+        self.max_in_flight = max_in_flight
+        self.partitions = partitions
+        self.partition_key = partition_key
+        self.drain_timeout = drain_timeout
+        self.beat = beat
+        self.stats_interval = stats_interval
+        self.limiter = limiter
+        self.executor_workers = executor_workers
+        self.task_factory = task_factory
+        self.listeners = []
+        # Channel -> messages parked for its full application instances
+        self.parked = {}
+        # Resolved, and replaced, whenever a channel stops having any
+        self.unparked = None
+        self.stopping = False
+        self.started = time.time()
+        self.reset_stats()
+
+    def start(self, loop):
+        """
+        Sets up the event loop the worker runs on, once it is running, with
+        the worker's loop options. SIGTERM stops the worker gracefully.
+        """
+        configure_loop(loop, self.executor_workers, self.task_factory)
+        logger.info("Using event loop %s", describe_loop(loop))
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self.stop)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # No signal support here (Windows, or not the main thread)
+            pass
+
+    def stop(self):
+        """
+        Stops listening on the channel layer, so handle() drains and returns.
+        """
+        self.stopping = True
+        for listener in self.listeners:
+            listener.cancel()
 
     async def handle(self):
         """
         Listens on all the provided channels and handles the messages.
         """
-        # For each channel, launch its own listening coroutine
-        listeners = []
-        for channel in self.channels:
-            listeners.append(asyncio.ensure_future(self.listener(channel)))
-        # Wait for them all to exit
-        await asyncio.wait(listeners)
+        # StatelessServer.run() may make a new loop, so set up this one
+        loop = asyncio.get_event_loop()
+        self.start(loop)
+        try:
+            await self.listen()
+        finally:
+            self.finish(loop)
+
+    def finish(self, loop):
+        """
+        Undoes start() once the worker is done with the loop.
+        """
+        try:
+            loop.remove_signal_handler(signal.SIGTERM)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass
+
+    async def listen(self):
+        """
+        Runs the listeners until they are stopped or one of them fails,
+        raising its error.
+        """
+        # Layers that can wait on several channels at once need only one
+        # listener for all of them
+        if "receive_any" in self.channel_layer.extensions:
+            self.listeners = [asyncio.ensure_future(self.multi_listener())]
+        else:
+            # Otherwise, for each channel, launch its own listening coroutine
+            self.listeners = [
+                asyncio.ensure_future(self.listener(channel))
+                for channel in self.channels
+            ]
+        if self.beat:
+            self.listeners.append(asyncio.ensure_future(self.beat_listener()))
+        if self.stats_interval:
+            self.listeners.append(asyncio.ensure_future(self.stats_reporter()))
+        # None of them exit unless stopped or broken, and the beat and stats
+        # reporter would carry on without the rest, so stop at the first
+        done, pending = await asyncio.wait(
+            self.listeners, return_when=asyncio.FIRST_COMPLETED
+        )
+        for listener in pending:
+            listener.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        if self.stopping:
+            await self.drain()
+            return
         # See if any of the listeners had an error (e.g. channel layer error)
-        [listener.result() for listener in listeners]
+        [listener.result() for listener in done]
+
+    async def drain(self):
+        """
+        Waits until application instances have taken all the messages queued
+        for them, or drain_timeout passes.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.drain_timeout
+        while loop.time() < deadline and any(
+            self.queued(details) for details in self.application_instances.values()
+        ):
+            await asyncio.sleep(0.05)
 
     async def listener(self, channel):
         """
         Single-channel listener
         """
         while True:
-            message = await self.channel_layer.receive(channel)
-            if not message.get("type", None):
-                raise ValueError("Worker received message with no type.")
-            # Make a scope and get an application instance for it
+            for _, message in await self.receive_open([channel]):
+                await self.handle_message(channel, message)
+
+    async def multi_listener(self):
+        """
+        Listener for all channels at once, for layers providing receive_any
+        """
+        while True:
+            for channel, message in await self.receive_open(self.channels):
+                await self.handle_message(channel, message)
+
+    async def beat_listener(self):
+        """
+        Passes scheduled messages from the beat to their channels as they come
+        due, sleeping until the next one in between.
+        """
+        while True:
+            delay = self.beat.next_fire() - time.time()
+            if delay > 0:
+                # Wake now and then anyway, in case the clock jumps
+                await asyncio.sleep(min(delay, 60))
+                continue
+            for channel, message in self.beat.pop_due(time.time()):
+                await self.handle_message(channel, message)
+
+    async def stats_reporter(self):
+        """
+        Logs the worker's stats every stats_interval seconds, each line
+        covering the time since the last.
+        """
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            stats = self.stats(reset=True)
+            logger.info("Worker stats %s", json.dumps(stats), extra={"stats": stats})
+
+    def reset_stats(self):
+        self.stats_since = time.time()
+        # Channel -> messages handled, and -> Histogram of their latency
+        self.message_counts = {}
+        self.latencies = {}
+        self.evicted = 0
+        self.reaped = 0
+
+    def stats(self, reset=False):
+        """
+        Returns a dict of the worker's stats since they were last reset:
+
+        * ``channels``: for each channel, the ``messages`` passed to its
+          application instances and their ``rate`` per second, the
+          ``latency`` percentiles (in seconds) from the worker taking
+          messages until an instance picked them up, and how many
+          ``instances`` and ``queued`` messages it has now
+        * ``instances`` alive now, out of ``max_applications``
+        * ``evicted``: instances shut down to keep under max_applications
+        * ``reaped``: instances cleaned up after they exited or crashed
+        * ``limiter``: the limiter's current ``limit``, messages
+          ``in_flight`` under it, and times listeners were ``throttled``,
+          if there is one
+        """
+        now = time.time()
+        elapsed = now - self.stats_since
+        channels = {}
+        for channel in self.channels:
+            latency = self.latencies.get(channel) or Histogram()
+            messages = self.message_counts.get(channel, 0)
+            channels[channel] = {
+                "messages": messages,
+                "rate": messages / elapsed if elapsed else 0.0,
+                "latency": {
+                    "p50": latency.percentile(0.5),
+                    "p90": latency.percentile(0.9),
+                    "p99": latency.percentile(0.99),
+                    "max": latency.max,
+                },
+                "instances": 0,
+                "queued": 0,
+            }
+        for details in self.application_instances.values():
+            channel_stats = channels.get(details["scope"]["channel"])
+            if channel_stats is not None:
+                channel_stats["instances"] += 1
+                channel_stats["queued"] += self.queued(details)
+        stats = {
+            "uptime": now - self.started,
+            "interval": elapsed,
+            "channels": channels,
+            "instances": len(self.application_instances),
+            "max_applications": self.max_applications,
+            "evicted": self.evicted,
+            "reaped": self.reaped,
+        }
+        if self.limiter is not None:
+            stats["limiter"] = self.limiter.stats()
+        if reset:
+            self.reset_stats()
+        return stats
+
+    async def room(self):
+        """
+        Returns how many messages to take next, waiting for the limiter to
+        have room if there is one.
+        """
+        if self.limiter is None:
+            return self.prefetch
+        return min(self.prefetch, await self.limiter.acquire())
+
+    async def receive_open(self, channels):
+        """
+        Receives the next messages from those of the channels without parked
+        messages, waiting while all of them have some. A receive is
+        cancelled, and started again, if another channel opens up meanwhile.
+        """
+        while True:
+            # Taken before looking, so an unpark meanwhile isn't missed
+            if self.unparked is None:
+                self.unparked = asyncio.get_event_loop().create_future()
+            unparked = self.unparked
+            open_channels = [
+                channel for channel in channels if channel not in self.parked
+            ]
+            if not open_channels:
+                # Waited on without cancelling it, as other listeners share it
+                await asyncio.wait([unparked])
+                continue
+            max_messages = await self.room()
+            if len(open_channels) == len(channels):
+                return await self.receive(open_channels, max_messages)
+            receiving = asyncio.ensure_future(self.receive(open_channels, max_messages))
+            try:
+                await asyncio.wait(
+                    [receiving, unparked], return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                receiving.cancel()
+            # It may have got its messages before it could be cancelled
+            await asyncio.wait([receiving])
+            if not receiving.cancelled():
+                return receiving.result()
+
+    async def receive(self, channels, max_messages=None):
+        """
+        Receives the next messages from the channels, as a list of (channel,
+        message) tuples. Prefetches up to max_messages (by default,
+        self.prefetch) of them at a time if the layer provides receive_many.
+        """
+        max_messages = max_messages or self.prefetch
+        extensions = self.channel_layer.extensions
+        if max_messages > 1 and "receive_many" in extensions:
+            return await self.channel_layer.receive_many(channels, max_messages)
+        if len(channels) == 1:
+            return [(channels[0], await self.channel_layer.receive(channels[0]))]
+        return [await self.channel_layer.receive_any(channels)]
+
+    async def handle_message(self, channel, message):
+        """
+        Passes a message received on a channel to its application instance.
+        """
+        if not message.get("type", None):
+            raise ValueError("Worker received message with no type.")
+        # Make a scope and get an application instance for it
+        if self.partitions > 1:
+            partition = self.get_partition(message)
+            scope = {"type": "channel", "channel": channel, "partition": partition}
+            scope_id = "%s#%d" % (channel, partition)
+        else:
             scope = {"type": "channel", "channel": channel}
-            instance_queue = self.get_or_create_application_instance(channel, scope)
-            # Run the message into the app
-            await instance_queue.put(message)
+            scope_id = channel
+        instance_queue = self.get_or_create_application_instance(scope_id, scope)
+        details = self.application_instances[scope_id]
+        self.message_counts[channel] = self.message_counts.get(channel, 0) + 1
+        if self.limiter is not None:
+            self.limiter.started()
+        # Run the message into the app, or park it if the app is full, rather
+        # than hold up messages for other instances
+        item = (time.monotonic(), details, message)
+        pending = details.get("pending")
+        if pending is not None and (
+            pending or instance_queue.qsize() >= self.max_in_flight
+        ):
+            pending.append(item)
+            self.parked[channel] = self.parked.get(channel, 0) + 1
+        else:
+            instance_queue.put_nowait(item)
+
+    def get_partition(self, message):
+        """
+        Returns the partition a message belongs in, from a stable hash of its
+        partition key.
+        """
+        key = message.get(self.partition_key)
+        if key is None:
+            return 0
+        if not isinstance(key, bytes):
+            key = str(key).encode("utf8")
+        return zlib.crc32(key) % self.partitions
+
+    def wrap_application(self, application):
+        """
+        Returns application as a single-callable application whose instances
+        take messages through make_receive().
+        """
+        application = guarantee_single_callable(application)
+
+        async def worker_application(scope, receive, send):
+            receive = self.make_receive(scope["channel"], receive)
+            return await application(scope=scope, receive=receive, send=send)
+
+        return worker_application
+
+    def get_or_create_application_instance(self, scope_id, scope):
+        """
+        Returns the queue of the application instance for scope_id, making
+        the instance if need be. New instances get somewhere to park
+        messages past max_in_flight, if that is set, and are reaped as soon
+        as they finish.
+        """
+        created = scope_id not in self.application_instances
+        input_queue = super().get_or_create_application_instance(scope_id, scope)
+        if created:
+            details = self.application_instances[scope_id]
+            if self.max_in_flight:
+                details["pending"] = collections.deque()
+            details["future"].add_done_callback(
+                functools.partial(self.application_finished, scope_id, details)
+            )
+        return input_queue
+
+    def make_receive(self, channel, receive):
+        """
+        Wraps an application instance's receive callable, unpacking messages
+        from its queue, moving up a parked one in their place, and recording
+        how long they waited.
+        """
+
+        async def worker_receive():
+            queued_at, details, message = await receive()
+            if details.get("pending"):
+                details["input_queue"].put_nowait(details["pending"].popleft())
+                self.unpark(channel, 1)
+            try:
+                latency = self.latencies[channel]
+            except KeyError:
+                latency = self.latencies[channel] = Histogram()
+            latency.add(time.monotonic() - queued_at)
+            if self.limiter is not None:
+                self.limiter.done(queued_at)
+            return message
+
+        return worker_receive
+
+    def delete_application_instance(self, scope_id):
+        """
+        Shuts down an application instance to make room for a new one.
+        """
+        self.evicted += 1
+        self.forget_queued(self.application_instances[scope_id])
+        super().delete_application_instance(scope_id)
+
+    def queued(self, details):
+        """
+        Returns how many messages are waiting for an application instance,
+        parked ones included.
+        """
+        return details["input_queue"].qsize() + len(details.get("pending", ()))
+
+    def unpark(self, channel, count):
+        """
+        Stops counting parked messages for a channel, letting listeners take
+        its messages again once it has none.
+        """
+        self.parked[channel] -= count
+        if not self.parked[channel]:
+            del self.parked[channel]
+            if self.unparked is not None:
+                # Wake the waiting listeners
+                self.unparked.set_result(None)
+                self.unparked = None
+
+    def forget_queued(self, details):
+        """
+        Stops the limiter counting messages queued for an application
+        instance that is going away, and stops counting its parked ones.
+        """
+        if self.limiter is not None:
+            self.limiter.release(self.queued(details))
+        pending = details.get("pending")
+        if pending:
+            self.unpark(details["scope"]["channel"], len(pending))
+            pending.clear()
+
+    def application_finished(self, scope_id, details, future):
+        """
+        Counts an application instance that finished while still in use.
+        The application checker cleans up those that exited or crashed.
+        """
+        if self.application_instances.get(scope_id) is details:
+            self.forget_queued(details)
+            self.reaped += 1
+            # The checker can't handle cancelled instances, so drop them now
+            if future.cancelled():
+                del self.application_instances[scope_id]
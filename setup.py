@@ -14,7 +14,7 @@ setup(
     python_requires='>=3.5',
     install_requires=[
         'Django>=2.2',
-        'asgiref~=3.2',
+        'asgiref~=3.3',
         'daphne~=2.3',
     ],
     extras_require={
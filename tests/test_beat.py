@@ -0,0 +1,219 @@
+import datetime
+import time
+
+import async_timeout
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+
+from channels.beat import Beat, BeatEntry, CronSchedule, IntervalSchedule
+from channels.layers import InMemoryChannelLayer
+from channels.worker import Worker
+
+from .test_worker import RecordingConsumer, run_worker
+
+
+def test_cron_schedule():
+    """
+    Tests that cron schedules find the next matching minute.
+    """
+    start = datetime.datetime(2020, 1, 1, 10, 7, 30).timestamp()
+
+    def next_after(expression, timestamp=start):
+        return datetime.datetime.fromtimestamp(
+            CronSchedule(expression).next_after(timestamp)
+        )
+
+    assert next_after("* * * * *") == datetime.datetime(2020, 1, 1, 10, 8)
+    assert next_after("*/15 * * * *") == datetime.datetime(2020, 1, 1, 10, 15)
+    assert next_after("0 3 * * *") == datetime.datetime(2020, 1, 2, 3, 0)
+    assert next_after("30 9 1 2 *") == datetime.datetime(2020, 2, 1, 9, 30)
+    # 2020-01-01 was a Wednesday; Sunday is 0 or 7
+    assert next_after("0 0 * * 0") == datetime.datetime(2020, 1, 5, 0, 0)
+    assert next_after("0 0 * * 7") == datetime.datetime(2020, 1, 5, 0, 0)
+    # Restricting both day fields matches either
+    assert next_after("0 0 4 * 0") == datetime.datetime(2020, 1, 4, 0, 0)
+    assert next_after("0 0 1 1 *") == datetime.datetime(2021, 1, 1, 0, 0)
+    for expression in ["* * * *", "60 * * * *", "*/0 * * * *", "5-1 * * * *"]:
+        with pytest.raises(ValueError):
+            CronSchedule(expression)
+    with pytest.raises(ValueError):
+        next_after("0 0 31 2 *")
+
+
+def test_cron_uneven_steps():
+    """
+    Tests that steps that don't divide a field's range run to the end of it
+    and then start again from the bottom.
+    """
+
+    def next_after(expression, moment):
+        return datetime.datetime.fromtimestamp(
+            CronSchedule(expression).next_after(moment.timestamp())
+        )
+
+    assert CronSchedule("*/7 * * * *").minutes == frozenset(range(0, 60, 7))
+    assert next_after("*/7 * * * *", datetime.datetime(2020, 1, 1, 10, 50)) == (
+        datetime.datetime(2020, 1, 1, 10, 56)
+    )
+    assert next_after("*/7 * * * *", datetime.datetime(2020, 1, 1, 10, 56)) == (
+        datetime.datetime(2020, 1, 1, 11, 0)
+    )
+    assert next_after("0 */5 * * *", datetime.datetime(2020, 1, 1, 20, 30)) == (
+        datetime.datetime(2020, 1, 2, 0, 0)
+    )
+    assert next_after("0 0 */10 * *", datetime.datetime(2020, 1, 31, 12, 0)) == (
+        datetime.datetime(2020, 2, 1, 0, 0)
+    )
+    assert CronSchedule("5/25 * * * *").minutes == frozenset([5, 30, 55])
+
+
+@pytest.fixture
+def new_york_time(monkeypatch):
+    """
+    Switches local time to New York's, with its daylight saving changes.
+    """
+    if not hasattr(time, "tzset"):
+        pytest.skip("Needs time.tzset()")
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_cron_daylight_saving(new_york_time):
+    """
+    Tests that cron schedules in local time run once, and always move
+    forward, across daylight saving changes.
+    """
+    utc = datetime.timezone.utc
+
+    def timestamp(*args):
+        return datetime.datetime(*args, tzinfo=utc).timestamp()
+
+    # 2020-03-08: 2:00 EST became 3:00 EDT (07:00 UTC), skipping 2:30
+    schedule = CronSchedule("30 2 * * *")
+    fire_at = schedule.next_after(timestamp(2020, 3, 8, 5, 0))
+    assert fire_at == timestamp(2020, 3, 8, 7, 30)
+    assert schedule.next_after(fire_at) == timestamp(2020, 3, 9, 6, 30)
+    # 2020-11-01: 2:00 EDT became 1:00 EST (06:00 UTC), repeating 1:30
+    schedule = CronSchedule("30 1 * * *")
+    fire_at = schedule.next_after(timestamp(2020, 11, 1, 4, 0))
+    assert fire_at == timestamp(2020, 11, 1, 5, 30)
+    assert schedule.next_after(fire_at) == timestamp(2020, 11, 2, 6, 30)
+    # During the repeated hour, the next run is still after now
+    schedule = CronSchedule("* * * * *")
+    assert schedule.next_after(timestamp(2020, 11, 1, 6, 10)) == (
+        timestamp(2020, 11, 1, 6, 11)
+    )
+
+
+def test_beat_catch_up():
+    """
+    Tests that the beat fires due runs in order and follows each entry's
+    catch_up policy for missed ones.
+    """
+    entries = [
+        BeatEntry(policy, policy, {"type": "tick"}, IntervalSchedule(10), **options)
+        for policy, options in [
+            ("once", {}),
+            ("all", {"catch_up": "all"}),
+            ("skip", {"catch_up": "skip", "jitter": 1}),
+        ]
+    ]
+    beat = Beat(entries, now=0)
+    assert len(beat) == 3
+    assert 10 <= beat.next_fire() <= 11
+    assert beat.pop_due(9) == []
+    assert sorted(channel for channel, _ in beat.pop_due(11)) == [
+        "all",
+        "once",
+        "skip",
+    ]
+    # Three runs (20, 30, 40) missed
+    sent = [channel for channel, _ in beat.pop_due(45)]
+    assert sorted(sent) == ["all", "all", "all", "once"]
+    assert 50 <= beat.next_fire() <= 51
+    with pytest.raises(ValueError):
+        BeatEntry(
+            "bad", "channel", {"type": "tick"}, IntervalSchedule(1), catch_up="later"
+        )
+
+
+def test_beat_from_settings():
+    """
+    Tests that the beat only takes settings entries for the given channels.
+    """
+    beat_settings = {
+        "ticks": {
+            "channel": "test-channel-1",
+            "message": {"type": "tick"},
+            "interval": 60,
+        },
+        "nightly": {
+            "channel": "test-channel-2",
+            "message": {"type": "tick"},
+            "cron": "0 0 * * *",
+            "jitter": 30,
+        },
+    }
+    with override_settings(CHANNELS_BEAT=beat_settings):
+        assert len(Beat.from_settings()) == 2
+        beat = Beat.from_settings(["test-channel-1"])
+        assert [entry.name for _, _, _, entry in beat.heap] == ["ticks"]
+        assert len(Beat.from_settings(["test-channel-3"])) == 0
+    beat_settings["ticks"]["cron"] = "* * * * *"
+    with override_settings(CHANNELS_BEAT=beat_settings):
+        with pytest.raises(ImproperlyConfigured):
+            Beat.from_settings()
+
+
+@pytest.mark.asyncio
+async def test_worker_beat():
+    """
+    Tests that a worker passes scheduled messages to its channel's
+    application instance.
+    """
+    RecordingConsumer.received = []
+    beat = Beat(
+        [
+            BeatEntry(
+                "ticks",
+                "test-channel-1",
+                {"type": "test.message", "n": 0},
+                IntervalSchedule(0.05),
+            )
+        ]
+    )
+    worker = Worker(
+        RecordingConsumer, ["test-channel-1"], InMemoryChannelLayer(), beat=beat
+    )
+    await run_worker(worker, lambda: len(RecordingConsumer.received) >= 3)
+    assert set(RecordingConsumer.received) == {("test-channel-1", 0)}
+    assert set(worker.application_instances) == {"test-channel-1"}
+
+
+@pytest.mark.asyncio
+async def test_beat_listener_error():
+    """
+    Tests that a worker with a beat still stops, raising the error, when a
+    channel listener fails.
+    """
+    channel_layer = InMemoryChannelLayer()
+    beat = Beat(
+        [
+            BeatEntry(
+                "ticks",
+                "test-channel-1",
+                {"type": "test.message", "n": 0},
+                IntervalSchedule(60),
+            )
+        ]
+    )
+    worker = Worker(RecordingConsumer, ["test-channel-1"], channel_layer, beat=beat)
+    await channel_layer.send("test-channel-1", {"n": 1})
+    with pytest.raises(ValueError):
+        async with async_timeout.timeout(1):
+            await worker.handle()
+    assert all(listener.done() for listener in worker.listeners)
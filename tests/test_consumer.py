@@ -0,0 +1,242 @@
+import asyncio
+import threading
+
+import async_timeout
+import pytest
+from django.test import override_settings
+
+from asgiref.testing import ApplicationCommunicator
+from channels.consumer import AsyncConsumer, SyncConsumer, get_type_handler_name
+from channels.exceptions import StopConsumer
+from channels.layers import get_channel_layer
+
+
+@pytest.mark.asyncio
+async def test_dispatch_table():
+    """
+    Tests that handlers are found however they are defined, even after the
+    type's handler name is cached, and that invalid message types are still
+    rejected.
+    """
+    results = []
+
+    class TestConsumer(AsyncConsumer):
+        async def test_message(self, message):
+            results.append(("base", message["n"]))
+
+        @staticmethod
+        async def static_message(message):
+            results.append(("static", message["n"]))
+
+    class SubConsumer(TestConsumer):
+        async def test_message(self, message):
+            results.append(("sub", message["n"]))
+
+    async def instance_handler(message):
+        results.append(("instance", message["n"]))
+
+    async def patched_handler(self, message):
+        results.append(("patched", message["n"]))
+
+    await TestConsumer({}).dispatch({"type": "test.message", "n": 1})
+    await SubConsumer({}).dispatch({"type": "test.message", "n": 2})
+    await TestConsumer({}).dispatch({"type": "static.message", "n": 3})
+    consumer = TestConsumer({})
+    consumer.test_message = instance_handler
+    await consumer.dispatch({"type": "test.message", "n": 4})
+    TestConsumer.test_message = patched_handler
+    await TestConsumer({}).dispatch({"type": "test.message", "n": 5})
+    assert results == [
+        ("base", 1),
+        ("sub", 2),
+        ("static", 3),
+        ("instance", 4),
+        ("patched", 5),
+    ]
+    with pytest.raises(ValueError):
+        await TestConsumer({}).dispatch({"type": "_test.message"})
+    with pytest.raises(ValueError):
+        await TestConsumer({}).dispatch({"n": 4})
+    with pytest.raises(ValueError):
+        await TestConsumer({}).dispatch({"type": "other.message"})
+
+
+@pytest.mark.asyncio
+async def test_concurrent_dispatch():
+    """
+    Tests that handlers run concurrently with max_concurrent_handlers set,
+    that messages with the same ordering key stay in order, and that
+    StopConsumer from any handler stops the consumer.
+    """
+    results = []
+    release = asyncio.Event()
+
+    class TestConsumer(AsyncConsumer):
+        max_concurrent_handlers = 3
+
+        def ordering_key(self, message):
+            return message.get("key")
+
+        async def test_wait(self, message):
+            await release.wait()
+            results.append(message["n"])
+
+        async def test_release(self, message):
+            results.append(message["n"])
+            release.set()
+
+        async def test_stop(self, message):
+            raise StopConsumer()
+
+    communicator = ApplicationCommunicator(TestConsumer, {"type": "test"})
+    await communicator.send_input({"type": "test.wait", "key": "a", "n": 1})
+    await communicator.send_input({"type": "test.wait", "key": "a", "n": 2})
+    await communicator.send_input({"type": "test.release", "key": "b", "n": 3})
+    async with async_timeout.timeout(1):
+        while len(results) < 3:
+            await asyncio.sleep(0.01)
+    assert results == [3, 1, 2]
+    await communicator.send_input({"type": "test.stop"})
+    await communicator.wait(timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_lazy_channel_layer():
+    """
+    Tests that consumers only listen on the channel layer once they read
+    their channel name.
+    """
+    results = {}
+
+    class TestConsumer(AsyncConsumer):
+        async def test_plain(self, message):
+            results["plain"] = True
+
+        async def test_name(self, message):
+            results["channel_name"] = self.channel_name
+
+        async def test_layer(self, message):
+            results["layer"] = True
+
+        async def test_stop(self, message):
+            raise StopConsumer()
+
+    channel_layers_setting = {
+        "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+    }
+    with override_settings(CHANNEL_LAYERS=channel_layers_setting):
+        channel_layer = get_channel_layer()
+        communicator = ApplicationCommunicator(TestConsumer, {"type": "test"})
+        await communicator.send_input({"type": "test.plain"})
+        async with async_timeout.timeout(1):
+            while "plain" not in results:
+                await asyncio.sleep(0.01)
+        assert channel_layer.channels == {}
+        # Reading the channel name starts the listener
+        await communicator.send_input({"type": "test.name"})
+        async with async_timeout.timeout(1):
+            while "channel_name" not in results:
+                await asyncio.sleep(0.01)
+        await channel_layer.send(results["channel_name"], {"type": "test.layer"})
+        async with async_timeout.timeout(1):
+            while "layer" not in results:
+                await asyncio.sleep(0.01)
+        await communicator.send_input({"type": "test.stop"})
+        await communicator.wait(timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_sync_send_buffer():
+    """
+    Tests that with buffer_sends, sync handlers' sends are passed on in order
+    once the handler returns, or straight away on flush(), while sends from
+    other threads aren't buffered.
+    """
+    flushed = threading.Event()
+    sends = []
+
+    class TestConsumer(SyncConsumer):
+        buffer_sends = True
+
+        def test_many(self, message):
+            for n in range(3):
+                self.send({"type": "test.reply", "n": n})
+            sends.append(len(self.send_buffer))
+
+        def test_thread(self, message):
+            thread = threading.Thread(
+                target=self.send, args=({"type": "test.reply", "n": "thread"},)
+            )
+            thread.start()
+            thread.join()
+            sends.append(len(self.send_buffer))
+
+        def test_flush(self, message):
+            self.send({"type": "test.reply", "n": "flushed"})
+            self.flush()
+            assert flushed.wait(1)
+            self.send({"type": "test.reply", "n": "after"})
+
+    communicator = ApplicationCommunicator(TestConsumer, {"type": "test"})
+    await communicator.send_input({"type": "test.many"})
+    for n in range(3):
+        assert (await communicator.receive_output())["n"] == n
+    await communicator.send_input({"type": "test.thread"})
+    assert (await communicator.receive_output())["n"] == "thread"
+    assert sends == [3, 0]
+    await communicator.send_input({"type": "test.flush"})
+    assert (await communicator.receive_output())["n"] == "flushed"
+    flushed.set()
+    assert (await communicator.receive_output())["n"] == "after"
+    communicator.stop()
+
+
+@pytest.mark.asyncio
+async def test_sync_send_unbuffered():
+    """
+    Tests that by default sync handlers' sends go out as they are made.
+    """
+    sent = threading.Event()
+
+    class TestConsumer(SyncConsumer):
+        def test_progress(self, message):
+            self.send({"type": "test.reply", "n": "started"})
+            assert sent.wait(1)
+            self.send({"type": "test.reply", "n": "done"})
+
+    communicator = ApplicationCommunicator(TestConsumer, {"type": "test"})
+    await communicator.send_input({"type": "test.progress"})
+    assert (await communicator.receive_output())["n"] == "started"
+    sent.set()
+    assert (await communicator.receive_output())["n"] == "done"
+    communicator.stop()
+
+
+@pytest.mark.asyncio
+async def test_batch_handlers():
+    """
+    Tests that messages of a type with a batch handler are passed to it
+    together, other types still go to their own handlers, and looking up
+    lots of made-up types doesn't grow any cache without bound.
+    """
+
+    class TestConsumer(SyncConsumer):
+        batch_timeout = 0.1
+
+        def test_update_batch(self, messages):
+            self.send({"type": "test.batch", "n": [m["n"] for m in messages]})
+
+        def test_other(self, message):
+            self.send({"type": "test.other"})
+
+    communicator = ApplicationCommunicator(TestConsumer, {"type": "test"})
+    for n in range(3):
+        await communicator.send_input({"type": "test.update", "n": n})
+    await communicator.send_input({"type": "test.other"})
+    assert await communicator.receive_output() == {"type": "test.batch", "n": [0, 1, 2]}
+    assert await communicator.receive_output() == {"type": "test.other"}
+    communicator.stop()
+    consumer = TestConsumer({"type": "test"})
+    for n in range(2000):
+        assert consumer.batch_key({"type": "made.up.%s" % n}) is None
+    assert get_type_handler_name.cache_info().currsize <= 1024
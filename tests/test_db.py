@@ -0,0 +1,126 @@
+import asyncio
+import threading
+from unittest.mock import patch
+
+import pytest
+from django.test import override_settings
+
+from channels.db import (
+    coalesced_database_sync_to_async,
+    database_sync_to_async,
+    maybe_coalesced_database_sync_to_async,
+)
+from channels.exceptions import ExecutorFull
+from channels.executors import BoundedThreadPoolExecutor
+
+
+def broken():
+    raise ValueError("Broken call")
+
+
+@pytest.mark.asyncio
+async def test_cleanup_every_call():
+    """
+    Tests that connections are cleaned up before and after every call by
+    default.
+    """
+    with patch("channels.db.close_old_connections") as close_old_connections:
+        for _ in range(3):
+            assert await database_sync_to_async(lambda: 42)() == 42
+    assert close_old_connections.call_count == 6
+
+
+@pytest.mark.asyncio
+async def test_cleanup_interval():
+    """
+    Tests that with a cleanup interval, each thread only cleans up once per
+    interval, or after a call raises.
+    """
+    executor = BoundedThreadPoolExecutor(max_workers=1)
+    with patch("channels.db.close_old_connections") as close_old_connections:
+        with override_settings(CHANNELS_DB_CLEANUP_INTERVAL=60):
+            for _ in range(3):
+                await database_sync_to_async(lambda: 42, executor=executor)()
+            assert close_old_connections.call_count == 1
+            with pytest.raises(ValueError):
+                await database_sync_to_async(broken, executor=executor)()
+            assert close_old_connections.call_count == 2
+        # The argument wins over the setting
+        with patch("channels.db.time.monotonic", return_value=10 ** 9):
+            await database_sync_to_async(
+                lambda: 42, executor=executor, cleanup_interval=0
+            )()
+            assert close_old_connections.call_count == 4
+            await database_sync_to_async(
+                lambda: 42, executor=executor, cleanup_interval=60
+            )()
+            assert close_old_connections.call_count == 5
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_coalesced_calls():
+    """
+    Tests that coalesced calls made together run in one thread with one
+    cleanup, and each caller gets its own outcome.
+    """
+    threads = set()
+
+    @coalesced_database_sync_to_async
+    def double(n):
+        threads.add(threading.get_ident())
+        if n == 2:
+            raise ValueError("Broken call")
+        return n * 2
+
+    with patch("channels.db.close_old_connections") as close_old_connections:
+        results = await asyncio.gather(
+            *[double(n) for n in range(5)], return_exceptions=True
+        )
+    assert results[:2] + results[3:] == [0, 2, 6, 8]
+    assert isinstance(results[2], ValueError)
+    assert len(threads) == 1
+    # Once before, once after, and once after the failed call
+    assert close_old_connections.call_count == 3
+    # A later call goes in a new batch
+    assert await double(10) == 20
+
+
+@pytest.mark.asyncio
+async def test_coalesced_executor_full():
+    """
+    Tests that every call in a batch gets the error when its executor is full.
+    """
+    executor = BoundedThreadPoolExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+    futures = [executor.submit(release.wait, 1)]
+    while executor.stats()["running"] < 1:
+        await asyncio.sleep(0.01)
+    futures.append(executor.submit(release.wait, 1))
+    call = coalesced_database_sync_to_async(lambda: 42, executor=executor)
+    results = await asyncio.gather(call(), call(), return_exceptions=True)
+    assert [type(result) for result in results] == [ExecutorFull, ExecutorFull]
+    release.set()
+    for future in futures:
+        future.result(1)
+    assert await call() == 42
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_coalesce_setting():
+    """
+    Tests that calls only coalesce when CHANNELS_COALESCE_DB_CALLS is on.
+    """
+
+    @maybe_coalesced_database_sync_to_async
+    def double(n):
+        return n * 2
+
+    with patch("channels.db.close_old_connections") as close_old_connections:
+        assert await asyncio.gather(*[double(n) for n in range(3)]) == [0, 2, 4]
+        assert close_old_connections.call_count == 6
+        close_old_connections.reset_mock()
+        with override_settings(CHANNELS_COALESCE_DB_CALLS=True):
+            assert await asyncio.gather(*[double(n) for n in range(3)]) == [0, 2, 4]
+        assert close_old_connections.call_count == 2
@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from asgiref.testing import ApplicationCommunicator
+from channels.consumer import SyncConsumer
+from channels.db import database_sync_to_async
+from channels.exceptions import ExecutorFull
+from channels.executors import BoundedThreadPoolExecutor
+
+
+def fill(executor, release):
+    """
+    Blocks the single thread of the executor and fills its queue.
+    """
+    futures = [executor.submit(release.wait, 1)]
+    while executor.stats()["running"] < 1:
+        time.sleep(0.01)
+    futures.append(executor.submit(release.wait, 1))
+    return futures
+
+
+def test_bounded_executor():
+    """
+    Tests that the executor rejects calls once its queue is full, and
+    counts what it ran.
+    """
+    executor = BoundedThreadPoolExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+    futures = fill(executor, release)
+    with pytest.raises(ExecutorFull):
+        executor.submit(release.wait, 1)
+    release.set()
+    assert [future.result(1) for future in futures] == [True, True]
+    stats = executor.stats()
+    assert stats["submitted"] == 2
+    assert stats["rejected"] == 1
+    assert stats["completed"] == 2
+    assert stats["queued"] == stats["running"] == 0
+    assert stats["wait_time"] > 0
+    assert stats["run_time"] > 0
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_executor_wait_for_room():
+    """
+    Tests that wait_for_room() returns straight away while the queue has
+    room, and otherwise once a queued call gets a thread.
+    """
+    executor = BoundedThreadPoolExecutor(max_workers=1, max_queue=1)
+    await executor.wait_for_room()
+    release = threading.Event()
+    futures = fill(executor, release)
+    waiting = asyncio.ensure_future(executor.wait_for_room())
+    await asyncio.sleep(0.05)
+    assert not waiting.done()
+    release.set()
+    await asyncio.wait_for(waiting, 1)
+    # A cancelled waiter is forgotten
+    for future in futures:
+        future.result(1)
+    release.clear()
+    futures = fill(executor, release)
+    waiting = asyncio.ensure_future(executor.wait_for_room())
+    await asyncio.sleep(0.05)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert executor.room_waiters == []
+    release.set()
+    for future in futures:
+        future.result(1)
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_database_sync_to_async_executor():
+    """
+    Tests that database_sync_to_async runs calls in its given executor, and
+    raises when it is full.
+    """
+    executor = BoundedThreadPoolExecutor(
+        max_workers=1, max_queue=1, thread_name_prefix="test-pool"
+    )
+    run_in_pool = database_sync_to_async(
+        lambda: threading.current_thread().name, executor=executor
+    )
+    assert (await run_in_pool()).startswith("test-pool")
+    release = threading.Event()
+    futures = fill(executor, release)
+    with pytest.raises(ExecutorFull):
+        await run_in_pool()
+    release.set()
+    for future in futures:
+        future.result(1)
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_consumer_executor():
+    """
+    Tests that a sync consumer with its own executor runs handlers there, and
+    can still send from them.
+    """
+    executor = BoundedThreadPoolExecutor(max_workers=1, thread_name_prefix="test-pool")
+
+    class TestConsumer(SyncConsumer):
+        def test_message(self, message):
+            self.send({"type": "test.reply", "thread": threading.current_thread().name})
+
+    TestConsumer.executor = executor
+    communicator = ApplicationCommunicator(TestConsumer, {"type": "test"})
+    await communicator.send_input({"type": "test.message"})
+    assert (await communicator.receive_output())["thread"].startswith("test-pool")
+    communicator.stop()
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_consumer_executor_full():
+    """
+    Tests that a sync consumer whose executor is full waits for room rather
+    than failing, and handles every message once it has it.
+    """
+    executor = BoundedThreadPoolExecutor(max_workers=1, max_queue=1)
+
+    class TestConsumer(SyncConsumer):
+        def test_message(self, message):
+            self.send({"type": "test.reply", "n": message["n"]})
+
+    TestConsumer.executor = executor
+    release = threading.Event()
+    futures = fill(executor, release)
+    communicator = ApplicationCommunicator(TestConsumer, {"type": "test"})
+    for n in range(3):
+        await communicator.send_input({"type": "test.message", "n": n})
+    await asyncio.sleep(0.1)
+    # Only the first try counts as a rejection, and the handler waits for
+    # room rather than polling
+    assert executor.stats()["rejected"] == 1
+    assert len(executor.room_waiters) == 1
+    release.set()
+    for n in range(3):
+        assert (await communicator.receive_output(1))["n"] == n
+    for future in futures:
+        future.result(1)
+    communicator.stop()
+    executor.shutdown()
@@ -1,17 +1,26 @@
+import asyncio
+import copy
+import json
 import re
+import threading
+import time
 import unittest
 from io import BytesIO
 from unittest.mock import MagicMock, patch
 
+import async_timeout
 import pytest
 from django.core.exceptions import RequestDataTooBig
 from django.http import HttpResponse, RawPostDataException
 from django.test import override_settings
+from django.urls import path
 
 from asgiref.testing import ApplicationCommunicator
 from channels.consumer import AsyncConsumer
 from channels.db import database_sync_to_async
-from channels.http import AsgiHandler, AsgiRequest
+from channels.exceptions import RequestAborted, RequestTimeout
+from channels.executors import BoundedThreadPoolExecutor
+from channels.http import AsgiHandler, AsgiRequest, BodyPipe
 from channels.sessions import SessionMiddlewareStack
 from channels.testing import HttpCommunicator
 
@@ -171,6 +180,81 @@ class RequestTests(unittest.TestCase):
 
         self.assertEqual(request.path, "/path/to/test/")
 
+    def test_lazy_meta(self):
+        """
+        Tests that headers only go into META once something looks for them,
+        and come out the same as if they had gone in straight away.
+        """
+        request = AsgiRequest(
+            {
+                "http_version": "1.1",
+                "method": "POST",
+                "path": "/test/",
+                "headers": [
+                    (b"host", b"example.com"),
+                    (b"content-type", b"text/plain; charset=latin1"),
+                    (b"content-length", b"4"),
+                    (b"x-forwarded-for", b"10.0.0.1"),
+                    (b"x-forwarded-for", b"10.0.0.2"),
+                    (b"x-custom", b"header"),
+                ],
+            },
+            BytesIO(b"body"),
+        )
+        self.assertEqual(request.content_type, "text/plain")
+        self.assertEqual(request.encoding, "latin1")
+        self.assertEqual(request.read(), b"body")
+        # Keys that are already there don't load the headers
+        self.assertEqual(request.META["REQUEST_METHOD"], "POST")
+        self.assertIsNotNone(request.META.headers)
+        # Set keys win over headers of the same name
+        request.META["HTTP_X_CUSTOM"] = "set"
+        self.assertEqual(request.META.get("HTTP_HOST"), "example.com")
+        self.assertIsNone(request.META.headers)
+        self.assertEqual(request.META["HTTP_X_FORWARDED_FOR"], "10.0.0.1,10.0.0.2")
+        self.assertEqual(request.META["HTTP_X_CUSTOM"], "set")
+        self.assertEqual(request.META["CONTENT_LENGTH"], "4")
+        self.assertIn("CONTENT_TYPE", dict(request.META.items()))
+        # Iterating loads them too
+        request = AsgiRequest(
+            {
+                "http_version": "1.1",
+                "method": "GET",
+                "path": "/test/",
+                "headers": [(b"host", b"example.com")],
+            },
+            BytesIO(b""),
+        )
+        self.assertIn("HTTP_HOST", list(request.META))
+
+    def test_lazy_meta_copies(self):
+        """
+        Tests that copies of META, however they are made, include the headers.
+        """
+        copiers = [
+            dict,
+            lambda meta: {**meta},
+            lambda meta: json.loads(json.dumps(meta)),
+            copy.copy,
+            copy.deepcopy,
+            lambda meta: dict(zip(reversed(meta), reversed(list(meta.values())))),
+        ]
+        for copier in copiers:
+            request = AsgiRequest(
+                {
+                    "http_version": "1.1",
+                    "method": "GET",
+                    "path": "/test/",
+                    "headers": [(b"host", b"example.com"), (b"x-custom", b"header")],
+                },
+                BytesIO(b""),
+            )
+            meta = copier(request.META)
+            self.assertEqual(meta["HTTP_HOST"], "example.com")
+            self.assertEqual(meta["HTTP_X_CUSTOM"], "header")
+            self.assertEqual(meta["REQUEST_METHOD"], "GET")
+            self.assertEqual(len(meta), len(request.META))
+
     def test_reading_body_after_stream_raises(self):
         request = AsgiRequest(
             {
@@ -327,6 +411,298 @@ async def test_handler_body_ignore_extra():
     assert body_stream.read() == b"chunk one"
 
 
+@pytest.mark.asyncio
+async def test_handler_body_large():
+    """
+    Tests that bodies over FILE_UPLOAD_MAX_MEMORY_SIZE go to a temporary
+    file, whether or not they say how long they are, and smaller ones stay
+    in memory.
+    """
+    for headers in [[], [(b"content-length", b"20")]]:
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": "POST",
+            "path": "/test/",
+            "headers": headers,
+        }
+        with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=15):
+            handler = ApplicationCommunicator(MockHandler, scope)
+            await handler.send_input(
+                {"type": "http.request", "body": b"chunk one ", "more_body": True}
+            )
+            await handler.send_input({"type": "http.request", "body": b"chunk two "})
+            await handler.receive_output(1)  # response start
+            await handler.receive_output(1)  # response body
+        scope, body_stream = MockHandler.request_class.call_args[0]
+        assert not isinstance(body_stream, BytesIO)
+        assert body_stream.read() == b"chunk one chunk two "
+    scope["headers"] = [(b"content-length", b"10")]
+    handler = ApplicationCommunicator(MockHandler, scope)
+    await handler.send_input({"type": "http.request", "body": b"chunk one "})
+    await handler.receive_output(1)  # response start
+    await handler.receive_output(1)  # response body
+    scope, body_stream = MockHandler.request_class.call_args[0]
+    assert isinstance(body_stream, BytesIO)
+    assert body_stream.read() == b"chunk one "
+
+
+@pytest.mark.asyncio
+async def test_handler_body_too_big():
+    """
+    Tests that with reject_large_bodies, the handler answers 413 without
+    reading the body when its Content-Length is over
+    DATA_UPLOAD_MAX_MEMORY_SIZE, unless it's multipart.
+    """
+
+    class RejectingHandler(MockHandler):
+        reject_large_bodies = True
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "path": "/test/",
+        "headers": [(b"content-length", b"1000")],
+    }
+    MockHandler.request_class.reset_mock()
+    with override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=10):
+        handler = ApplicationCommunicator(RejectingHandler, scope)
+        response_start = await handler.receive_output(1)
+        assert response_start["status"] == 413
+        await handler.receive_output(1)  # response body
+        assert not MockHandler.request_class.called
+        # It's off by default, leaving the view to read the body
+        handler = ApplicationCommunicator(MockHandler, scope)
+        await handler.send_input({"type": "http.request", "body": b"x" * 1000})
+        response_start = await handler.receive_output(1)
+        assert response_start["status"] == 200
+        await handler.receive_output(1)  # response body
+        assert MockHandler.request_class.called
+        scope["headers"].append((b"content-type", b"multipart/form-data; boundary=B"))
+        handler = ApplicationCommunicator(RejectingHandler, scope)
+        await handler.send_input({"type": "http.request", "body": b"x" * 1000})
+        response_start = await handler.receive_output(1)
+        assert response_start["status"] == 200
+        await handler.receive_output(1)  # response body
+
+
+@pytest.mark.asyncio
+async def test_body_pipe():
+    """
+    Tests that the body pipe makes writes wait while it's full, and passes
+    on the end of the body or the error it ended with.
+    """
+    loop = asyncio.get_event_loop()
+    pipe = BodyPipe(max_buffer=4, timeout=1)
+    await pipe.write(b"abcd")
+    writing = asyncio.ensure_future(pipe.write(b"ef"))
+    await asyncio.sleep(0.01)
+    assert not writing.done()
+    assert await loop.run_in_executor(None, pipe.read, 3) == b"abc"
+    await writing
+    pipe.finish()
+    assert await loop.run_in_executor(None, pipe.read) == b"def"
+    assert pipe.read() == b""
+    pipe = BodyPipe(timeout=1)
+    await pipe.write(b"abc")
+    pipe.finish(RequestAborted())
+    assert pipe.read(5) == b"abc"
+    with pytest.raises(RequestAborted):
+        pipe.read()
+    with pytest.raises(RequestTimeout):
+        BodyPipe(timeout=0.01).read()
+
+
+@pytest.mark.asyncio
+async def test_handler_streaming_body():
+    """
+    Tests that a streaming handler starts the view before the body has all
+    arrived, and lets it read the body as it comes in.
+    """
+    first_read = threading.Event()
+
+    class StreamingHandler(AsgiHandler):
+        stream_request_body = True
+
+        def get_response(self, request):
+            first = request.read(6)
+            first_read.set()
+            return HttpResponse(first + b"|" + request.read())
+
+    scope = {"type": "http", "http_version": "1.1", "method": "POST", "path": "/"}
+    handler = ApplicationCommunicator(StreamingHandler, scope)
+    await handler.send_input(
+        {"type": "http.request", "body": b"chunk ", "more_body": True}
+    )
+    async with async_timeout.timeout(1):
+        while not first_read.is_set():
+            await asyncio.sleep(0.01)
+    await handler.send_input({"type": "http.request", "body": b"two"})
+    response_start = await handler.receive_output(1)
+    assert response_start["status"] == 200
+    response_body = await handler.receive_output(1)
+    assert response_body["body"] == b"chunk |two"
+
+
+def upload_view(request):
+    return HttpResponse(str(len(request.read())))
+
+
+urlpatterns = [path("upload/", upload_view)]
+
+
+class StreamingUploadHandler(AsgiHandler):
+    stream_request_body = True
+
+
+@pytest.mark.asyncio
+async def test_handler_streaming_disconnect(caplog):
+    """
+    Tests that a streaming handler sends nothing, and logs no error, when
+    the client disconnects part way through a body the view is reading.
+    """
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "path": "/upload/",
+    }
+    with override_settings(ROOT_URLCONF=__name__):
+        handler = ApplicationCommunicator(StreamingUploadHandler, scope)
+        await handler.send_input(
+            {"type": "http.request", "body": b"part", "more_body": True}
+        )
+        await handler.send_input({"type": "http.disconnect"})
+        await handler.wait(1)
+    assert await handler.receive_nothing()
+    assert not [record for record in caplog.records if record.levelname == "ERROR"]
+
+
+@pytest.mark.asyncio
+async def test_handler_streaming_stalled(caplog):
+    """
+    Tests that a streaming handler answers 408, without logging an error,
+    when the body stops arriving, or takes longer than stream_body_timeout
+    in all.
+    """
+
+    class StallingRequest(AsgiRequest):
+        body_receive_timeout = 0.1
+
+    class StalledHandler(StreamingUploadHandler):
+        request_class = StallingRequest
+
+    class SlowHandler(StreamingUploadHandler):
+        stream_body_timeout = 0.2
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "path": "/upload/",
+    }
+    with override_settings(ROOT_URLCONF=__name__):
+        handler = ApplicationCommunicator(StalledHandler, scope)
+        await handler.send_input(
+            {"type": "http.request", "body": b"part", "more_body": True}
+        )
+        response_start = await handler.receive_output(1)
+        assert response_start["status"] == 408
+        await handler.receive_output(1)  # response body
+        # A body that trickles in still runs out of time
+        handler = ApplicationCommunicator(SlowHandler, scope)
+        async with async_timeout.timeout(1):
+            while True:
+                await handler.send_input(
+                    {"type": "http.request", "body": b"part", "more_body": True}
+                )
+                if not await handler.receive_nothing(0.05):
+                    break
+        response_start = await handler.receive_output(1)
+        assert response_start["status"] == 408
+    assert not [record for record in caplog.records if record.levelname == "ERROR"]
+
+
+class PostReadingMiddleware:
+    """
+    Middleware that reads the request body before the view gets it, as
+    CsrfViewMiddleware does.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.POST
+        return self.get_response(request)
+
+
+@pytest.mark.asyncio
+async def test_handler_streaming_stalled_middleware(caplog):
+    """
+    Tests that a streaming handler answers 408, logging a warning rather than
+    an error, when the body stalls while middleware is reading it.
+    """
+
+    class StallingRequest(AsgiRequest):
+        body_receive_timeout = 0.1
+
+    class StalledHandler(StreamingUploadHandler):
+        request_class = StallingRequest
+        # Don't share the middleware chain cached for the other handlers
+        _middleware_chain = None
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "path": "/upload/",
+        "headers": [(b"content-type", b"application/x-www-form-urlencoded")],
+    }
+    with override_settings(
+        ROOT_URLCONF=__name__, MIDDLEWARE=["tests.test_http.PostReadingMiddleware"],
+    ):
+        handler = ApplicationCommunicator(StalledHandler, scope)
+        await handler.send_input(
+            {"type": "http.request", "body": b"a=1", "more_body": True}
+        )
+        response_start = await handler.receive_output(1)
+        assert response_start["status"] == 408
+        await handler.receive_output(1)  # response body
+    assert not [record for record in caplog.records if record.levelname == "ERROR"]
+    assert [
+        record
+        for record in caplog.records
+        if record.levelname == "WARNING" and record.status_code == 408
+    ]
+
+
+@pytest.mark.asyncio
+async def test_handler_executor_full():
+    """
+    Tests the handler answers 503 when its executor has no room for the view
+    """
+    executor = BoundedThreadPoolExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+    executor.submit(release.wait, 1)
+    while executor.stats()["running"] < 1:
+        time.sleep(0.01)
+    executor.submit(release.wait, 1)
+
+    class FullHandler(MockHandler):
+        pass
+
+    FullHandler.executor = executor
+    scope = {"type": "http", "http_version": "1.1", "method": "GET", "path": "/test/"}
+    handler = ApplicationCommunicator(FullHandler, scope)
+    await handler.send_input({"type": "http.request"})
+    response_start = await handler.receive_output(1)
+    assert response_start["status"] == 503
+    release.set()
+    executor.shutdown()
+
+
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio
 async def test_sessions():
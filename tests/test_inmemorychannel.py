@@ -1,4 +1,5 @@
 import asyncio
+from unittest.mock import patch
 
 import async_timeout
 import pytest
@@ -106,3 +107,168 @@ async def test_groups_channel_full(channel_layer):
     await channel_layer.group_send("test-group", {"type": "message.1"})
     await channel_layer.group_send("test-group", {"type": "message.1"})
     await channel_layer.group_send("test-group", {"type": "message.1"})
+
+
+@pytest.mark.asyncio
+async def test_groups_process_fanout():
+    """
+    Tests that group_send writes one envelope per process rather than one
+    message per process-specific channel.
+    """
+    channel_layer = InMemoryChannelLayer()
+    local_channels = [await channel_layer.new_channel() for _ in range(3)]
+    for channel in local_channels + ["test-gr-chan-1"]:
+        await channel_layer.group_add("test-group", channel)
+    # Count the sends that actually hit the layer
+    sent_to = []
+    send = channel_layer.send
+
+    async def counting_send(channel, message, **kwargs):
+        sent_to.append(channel)
+        await send(channel, message, **kwargs)
+
+    channel_layer.send = counting_send
+    await channel_layer.group_send("test-group", {"type": "message.1"})
+    assert sorted(sent_to) == sorted(
+        [channel_layer.non_local_name(local_channels[0]), "test-gr-chan-1"]
+    )
+    # Every member still gets its own copy, without the envelope key
+    async with async_timeout.timeout(1):
+        for channel in local_channels + ["test-gr-chan-1"]:
+            assert await channel_layer.receive(channel) == {"type": "message.1"}
+
+
+@pytest.mark.asyncio
+async def test_groups_expiry():
+    """
+    Tests that group memberships older than group_expiry are dropped, and
+    that re-joining a group refreshes the join time.
+    """
+    channel_layer = InMemoryChannelLayer(group_expiry=60)
+    with patch("channels.layers.time.time", return_value=1000):
+        await channel_layer.group_add("test-group", "test-gr-chan-1")
+        await channel_layer.group_add("test-group", "test-gr-chan-2")
+        await channel_layer.group_add("other-group", "test-gr-chan-1")
+    with patch("channels.layers.time.time", return_value=1050):
+        await channel_layer.group_add("test-group", "test-gr-chan-1")
+    with patch("channels.layers.time.time", return_value=1100):
+        await channel_layer.group_send("test-group", {"type": "message.1"})
+        assert channel_layer.groups == {"test-group": {"test-gr-chan-1": 1050}}
+        async with async_timeout.timeout(1):
+            message = await channel_layer.receive("test-gr-chan-1")
+            assert message["type"] == "message.1"
+    # Join times keep their precision
+    with patch("channels.layers.time.time", return_value=1100.5):
+        await channel_layer.group_add("test-group", "test-gr-chan-2")
+    assert channel_layer.groups["test-group"] == {
+        "test-gr-chan-1": 1050,
+        "test-gr-chan-2": 1100.5,
+    }
+    with patch("channels.layers.time.time", return_value=1110.2):
+        channel_layer._clean_expired()
+        assert channel_layer.groups == {"test-group": {"test-gr-chan-2": 1100.5}}
+
+
+@pytest.mark.asyncio
+async def test_priority_lanes(channel_layer):
+    """
+    Tests that receive() serves higher priority messages first, keeping
+    order within a priority.
+    """
+    await channel_layer.send("test-channel-1", {"type": "bulk.1"})
+    await channel_layer.send("test-channel-1", {"type": "bulk.2"})
+    await channel_layer.send("test-channel-1", {"type": "websocket.close"}, priority=2)
+    assert (await channel_layer.receive("test-channel-1"))["type"] == "websocket.close"
+    assert (await channel_layer.receive("test-channel-1"))["type"] == "bulk.1"
+    assert (await channel_layer.receive("test-channel-1"))["type"] == "bulk.2"
+    with pytest.raises(ValueError):
+        await channel_layer.send("test-channel-1", {"type": "bulk.3"}, priority=3)
+    with pytest.raises(TypeError):
+        await channel_layer.send("test-channel-1", {"type": "bulk.3"}, priority="1")
+    # Group sends check their arguments even when the group is empty
+    with pytest.raises(ValueError):
+        await channel_layer.group_send("test-group", {"type": "bulk.3"}, priority=-1)
+    with pytest.raises(ValueError):
+        await channel_layer.group_send("test-group", {"type": "bulk.3"}, ttl=0)
+
+
+@pytest.mark.asyncio
+async def test_message_ttl():
+    """
+    Tests that messages expire on their own ttl rather than the layer expiry.
+    """
+    channel_layer = InMemoryChannelLayer(expiry=60)
+    await channel_layer.send("test-channel-1", {"type": "short.lived"}, ttl=0.1)
+    await channel_layer.send("test-channel-1", {"type": "long.lived"})
+    await asyncio.sleep(0.2)
+    assert (await channel_layer.receive("test-channel-1"))["type"] == "long.lived"
+    assert channel_layer.channels == {}
+
+
+@pytest.mark.asyncio
+async def test_message_ttl_keeps_groups():
+    """
+    Tests that a message expiring on its own short ttl doesn't remove its
+    channel from its groups, while one left for the layer expiry does.
+    """
+    channel_layer = InMemoryChannelLayer(expiry=0.1)
+    await channel_layer.group_add("test-group", "test-gr-chan-1")
+    await channel_layer.group_send("test-group", {"type": "short.lived"}, ttl=0.05)
+    await asyncio.sleep(0.06)
+    await channel_layer.group_send("test-group", {"type": "message.1"})
+    assert set(channel_layer.groups["test-group"]) == {"test-gr-chan-1"}
+    await asyncio.sleep(0.15)
+    await channel_layer.group_send("test-group", {"type": "message.2"})
+    assert channel_layer.groups == {}
+
+
+@pytest.mark.asyncio
+async def test_receive_any(channel_layer):
+    """
+    Tests receiving from whichever of several channels gets a message first.
+    """
+    receiving = asyncio.ensure_future(
+        channel_layer.receive_any(["test-channel-1", "test-channel-2"])
+    )
+    await asyncio.sleep(0)
+    await channel_layer.send("test-channel-2", {"type": "message.2"})
+    async with async_timeout.timeout(1):
+        channel, message = await receiving
+    assert channel == "test-channel-2"
+    assert message["type"] == "message.2"
+    # The waiter is gone from the channel that didn't get anything
+    assert channel_layer.channels == {}
+    with pytest.raises(asyncio.TimeoutError):
+        await channel_layer.receive_any(["test-channel-1"], timeout=0.1)
+
+
+@pytest.mark.asyncio
+async def test_receive_any_no_channels():
+    """
+    Tests that receiving from no channels at all is an error, even when
+    assertions are off.
+    """
+    channel_layer = InMemoryChannelLayer()
+    with pytest.raises(ValueError, match="at least one channel"):
+        await channel_layer.receive_any([])
+    with pytest.raises(ValueError, match="at least one channel"):
+        await channel_layer.receive_many([], 5)
+
+
+@pytest.mark.asyncio
+async def test_receive_many(channel_layer):
+    """
+    Tests receiving several waiting messages at once.
+    """
+    for n in range(3):
+        await channel_layer.send("test-channel-1", {"type": "message.1", "n": n})
+    await channel_layer.send("test-channel-2", {"type": "message.2", "n": 0})
+    received = await channel_layer.receive_many(["test-channel-1", "test-channel-2"], 3)
+    assert len(received) == 3
+    received += await channel_layer.receive_many(
+        ["test-channel-1", "test-channel-2"], 3
+    )
+    assert [m["n"] for c, m in received if c == "test-channel-1"] == [0, 1, 2]
+    assert [m["n"] for c, m in received if c == "test-channel-2"] == [0]
+    assert channel_layer.channels == {}
+    assert channel_layer.queued == 0
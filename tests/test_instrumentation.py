@@ -0,0 +1,86 @@
+import pytest
+
+from asgiref.testing import ApplicationCommunicator
+from channels.consumer import AsyncConsumer, SyncConsumer
+from channels.exceptions import StopConsumer
+from channels.instrumentation import Histogram, HistogramRecorder
+
+
+def test_histogram():
+    """
+    Tests values are counted into the right buckets.
+    """
+    histogram = Histogram(buckets=(0.1, 1.0, float("inf")))
+    assert histogram.percentile(0.5) is None
+    for value in [0.05, 0.05, 0.5, 5.0]:
+        histogram.add(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.percentile(0.5) == 0.1
+    assert histogram.percentile(0.75) == 1.0
+    assert histogram.percentile(1) == 5.0
+    assert histogram.as_dict()["total"] == pytest.approx(5.6)
+
+
+@pytest.mark.asyncio
+async def test_async_consumer_recorder():
+    """
+    Tests that async consumers record handler times, message ages (for every
+    message in a batch, too) and errors.
+    """
+
+    class TestConsumer(AsyncConsumer):
+        recorder = HistogramRecorder()
+        batch_timeout = 0.1
+
+        async def test_ok(self, message):
+            await self.send({"type": "test.done"})
+
+        async def test_many_batch(self, messages):
+            await self.send({"type": "test.done", "n": len(messages)})
+
+        async def test_broken(self, message):
+            raise ValueError("Broken handler")
+
+    communicator = ApplicationCommunicator(TestConsumer, {"type": "test"})
+    await communicator.send_input({"type": "test.ok"})
+    await communicator.send_input({"type": "test.ok"})
+    await communicator.receive_output()
+    await communicator.receive_output()
+    for _ in range(3):
+        await communicator.send_input({"type": "test.many"})
+    assert (await communicator.receive_output())["n"] == 3
+    await communicator.send_input({"type": "test.broken"})
+    with pytest.raises(ValueError):
+        await communicator.wait()
+    stats = TestConsumer.recorder.stats()
+    assert stats["handler_time"]["test.ok"]["count"] == 2
+    assert stats["handler_time"]["test.broken"]["count"] == 1
+    assert stats["message_age"]["test.ok"]["count"] == 2
+    assert stats["message_age"]["test.many"]["count"] == 3
+    assert stats["handler_time"]["test.many"]["count"] == 1
+    assert stats["errors"] == {"test.broken": {"ValueError": 1}}
+    assert "queue_wait" not in stats
+
+
+@pytest.mark.asyncio
+async def test_sync_consumer_recorder():
+    """
+    Tests that sync consumers also record how long handlers waited for a
+    thread.
+    """
+
+    class TestConsumer(SyncConsumer):
+        recorder = HistogramRecorder()
+
+        def test_ok(self, message):
+            self.send({"type": "test.done"})
+            raise StopConsumer()
+
+    communicator = ApplicationCommunicator(TestConsumer, {"type": "test"})
+    await communicator.send_input({"type": "test.ok"})
+    await communicator.receive_output()
+    # The send goes out before the handler returns, so wait for it to finish
+    await communicator.wait(1)
+    stats = TestConsumer.recorder.stats()
+    assert stats["queue_wait"]["test.ok"]["count"] == 1
+    assert stats["handler_time"]["test.ok"]["count"] == 1
@@ -0,0 +1,84 @@
+import asyncio
+import sys
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+
+from channels.loops import (
+    configure_loop,
+    describe_loop,
+    get_loop_options,
+    install_loop_policy,
+    loop_matches,
+)
+
+
+def recording_task_factory(loop, coro):
+    """
+    Task factory that marks the tasks it makes.
+    """
+    task = asyncio.Task(coro, loop=loop)
+    task.from_factory = True
+    return task
+
+
+@pytest.fixture
+def default_policy():
+    yield
+    asyncio.set_event_loop_policy(None)
+
+
+@override_settings(CHANNELS_EVENT_LOOP={"loop": "uvloop", "executor_workers": 4})
+def test_loop_options():
+    """
+    Tests that loop options given directly override the setting.
+    """
+    assert get_loop_options() == {
+        "loop": "uvloop",
+        "executor_workers": 4,
+        "task_factory": None,
+    }
+    assert get_loop_options(loop="asyncio", task_factory="a.b") == {
+        "loop": "asyncio",
+        "executor_workers": 4,
+        "task_factory": "a.b",
+    }
+
+
+def test_install_loop_policy(default_policy, monkeypatch):
+    """
+    Tests installing event loop policies by name, falling back to asyncio
+    when uvloop isn't installed.
+    """
+    assert install_loop_policy(None) is None
+    monkeypatch.setitem(sys.modules, "uvloop", None)
+    assert install_loop_policy("uvloop") == "asyncio"
+    assert type(asyncio.get_event_loop_policy()) is asyncio.DefaultEventLoopPolicy
+    assert (
+        install_loop_policy("asyncio.DefaultEventLoopPolicy")
+        == "asyncio.DefaultEventLoopPolicy"
+    )
+    with pytest.raises(ImproperlyConfigured):
+        install_loop_policy("tests.missing.Policy")
+
+
+def test_configure_loop():
+    """
+    Tests setting a loop's default executor size and task factory.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        configure_loop(
+            loop,
+            executor_workers=3,
+            task_factory="tests.test_loops.recording_task_factory",
+        )
+        assert loop._default_executor._max_workers == 3
+        task = loop.create_task(asyncio.sleep(0))
+        assert task.from_factory
+        loop.run_until_complete(task)
+        assert loop_matches(loop, "asyncio")
+        assert describe_loop(loop).startswith("asyncio.")
+    finally:
+        loop.close()
@@ -0,0 +1,82 @@
+import os
+import signal
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.supervisor import Supervisor
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Needs os.fork()")
+def test_supervisor(tmp_path):
+    """
+    Tests that the supervisor runs each child, restarts ones that crash and
+    stops them all when it gets SIGTERM.
+    """
+    started = tmp_path / "started"
+
+    def target(index):
+        with open(str(started), "a") as log:
+            log.write("%s\n" % index)
+        # The first child crashes the first time it runs
+        if index == 0 and not (tmp_path / "crashed").exists():
+            (tmp_path / "crashed").touch()
+            raise ValueError("Crashed child")
+        time.sleep(10)
+
+    def runs():
+        if not started.exists():
+            return []
+        return sorted(started.read_text().split())
+
+    def stop_when_restarted():
+        deadline = time.monotonic() + 5
+        while runs() != ["0", "0", "1"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    supervisor = Supervisor(target, 2)
+    supervisor.min_backoff = 0.01
+    supervisor.poll_interval = 0.01
+    stopper = threading.Thread(target=stop_when_restarted)
+    stopper.start()
+    supervisor.run()
+    stopper.join()
+    assert runs() == ["0", "0", "1"]
+    assert supervisor.children == {}
+    assert supervisor.backoffs == {0: 0.01}
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Needs os.fork()")
+def test_supervisor_fork(tmp_path):
+    """
+    Tests that the supervisor closes connections before forking, and that
+    children ignore SIGINT, leaving it to the supervisor to stop them.
+    """
+    handlers = tmp_path / "handlers"
+
+    def target(index):
+        handlers.write_text(str(signal.getsignal(signal.SIGINT) == signal.SIG_IGN))
+        time.sleep(10)
+
+    def stop_when_started():
+        deadline = time.monotonic() + 5
+        while not handlers.exists() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGINT)
+
+    channel_layers.backends = {"test": InMemoryChannelLayer()}
+    supervisor = Supervisor(target, 1)
+    supervisor.poll_interval = 0.01
+    stopper = threading.Thread(target=stop_when_started)
+    stopper.start()
+    with patch("channels.supervisor.connections") as connections:
+        supervisor.run()
+    stopper.join()
+    assert handlers.read_text() == "True"
+    assert connections.close_all.call_count == 1
+    assert channel_layers.backends == {}
+    assert supervisor.children == {}
@@ -0,0 +1,97 @@
+import asyncio
+
+import async_timeout
+import pytest
+
+from channels.exceptions import StopConsumer
+from channels.utils import DispatchLoop, await_many_dispatch
+
+
+@pytest.mark.asyncio
+async def test_await_many_dispatch():
+    """
+    Tests that results from every callable get dispatched, keeping the order
+    of each callable's results, by one reader task per callable that is
+    cancelled when the loop exits.
+    """
+    first, second = asyncio.Queue(), asyncio.Queue()
+    for n in range(3):
+        first.put_nowait(("first", n))
+        second.put_nowait(("second", n))
+    dispatched = []
+    tasks = []
+
+    async def dispatch(result):
+        dispatched.append(result)
+        if len(dispatched) == 6:
+            raise StopConsumer()
+
+    def recording_task_factory(loop, coro):
+        task = asyncio.Task(coro, loop=loop)
+        tasks.append(task)
+        return task
+
+    loop = asyncio.get_event_loop()
+    loop.set_task_factory(recording_task_factory)
+    try:
+        with pytest.raises(StopConsumer):
+            async with async_timeout.timeout(1):
+                await await_many_dispatch([first.get, second.get], dispatch)
+    finally:
+        loop.set_task_factory(None)
+    # Each source keeps its order
+    assert [n for name, n in dispatched if name == "first"] == [0, 1, 2]
+    assert [n for name, n in dispatched if name == "second"] == [0, 1, 2]
+    # Six results came from just the two reader tasks, now cancelled
+    assert len(tasks) == 2
+    assert all(task.cancelled() for task in tasks)
+
+
+@pytest.mark.asyncio
+async def test_await_many_dispatch_error():
+    """
+    Tests that an error from a callable is raised out of the dispatch loop.
+    """
+
+    async def broken():
+        raise ValueError("Broken source")
+
+    async def dispatch(result):
+        pass
+
+    with pytest.raises(ValueError):
+        async with async_timeout.timeout(1):
+            await await_many_dispatch([asyncio.Queue().get, broken], dispatch)
+
+
+@pytest.mark.asyncio
+async def test_dispatch_loop_batches():
+    """
+    Tests that results with a batch key are dispatched together, in order,
+    up to the batch size and until a result with another key comes in.
+    """
+    source = asyncio.Queue()
+    for result in ["a1", "a2", "a3", "b1", "a4", "stop"]:
+        source.put_nowait(result)
+    dispatched = []
+
+    async def dispatch(result):
+        dispatched.append(result)
+        if result == "stop":
+            raise StopConsumer()
+
+    async def dispatch_batch(results):
+        dispatched.append(results)
+
+    dispatch_loop = DispatchLoop(
+        dispatch,
+        batch_key=lambda result: "a" if result.startswith("a") else None,
+        dispatch_batch=dispatch_batch,
+        batch_size=2,
+        batch_timeout=1,
+    )
+    dispatch_loop.add(source.get)
+    with pytest.raises(StopConsumer):
+        async with async_timeout.timeout(1):
+            await dispatch_loop.run()
+    assert dispatched == [["a1", "a2"], ["a3"], "b1", ["a4"], "stop"]
@@ -0,0 +1,417 @@
+import asyncio
+import os
+import signal
+import time
+
+import async_timeout
+import pytest
+
+from channels.beat import Beat, BeatEntry, IntervalSchedule
+from channels.consumer import AsyncConsumer
+from channels.layers import InMemoryChannelLayer
+from channels.worker import AdaptiveLimiter, Worker
+
+
+class RecordingConsumer(AsyncConsumer):
+    """
+    Consumer that records every message it gets, keyed by its channel.
+    """
+
+    received = []
+
+    async def test_message(self, message):
+        self.received.append((self.scope["channel"], message["n"]))
+
+
+async def run_worker(worker, until):
+    """
+    Runs the worker's listeners until the until() callable returns true.
+    """
+    task = asyncio.ensure_future(worker.handle())
+    try:
+        async with async_timeout.timeout(2):
+            while not until():
+                await asyncio.sleep(0.01)
+    finally:
+        task.cancel()
+        for details in worker.application_instances.values():
+            details["future"].cancel()
+
+
+@pytest.mark.asyncio
+async def test_worker_multiple_channels():
+    """
+    Tests that a worker passes messages from all of its channels to an
+    application instance per channel.
+    """
+    RecordingConsumer.received = []
+    channel_layer = InMemoryChannelLayer()
+    worker = Worker(
+        RecordingConsumer, ["test-channel-1", "test-channel-2"], channel_layer
+    )
+    await channel_layer.send("test-channel-1", {"type": "test.message", "n": 1})
+    await channel_layer.send("test-channel-2", {"type": "test.message", "n": 2})
+    await run_worker(worker, lambda: len(RecordingConsumer.received) == 2)
+    assert sorted(RecordingConsumer.received) == [
+        ("test-channel-1", 1),
+        ("test-channel-2", 2),
+    ]
+    assert set(worker.application_instances) == {"test-channel-1", "test-channel-2"}
+
+
+@pytest.mark.asyncio
+async def test_worker_prefetch():
+    """
+    Tests that a worker with prefetch set pulls several messages per layer
+    call, and bounds each application instance's queue.
+    """
+    RecordingConsumer.received = []
+    channel_layer = InMemoryChannelLayer()
+    batches = []
+    queued = []
+    receive_many = channel_layer.receive_many
+
+    async def recording_receive_many(channels, max_messages):
+        queued.extend(
+            details["input_queue"].qsize()
+            for details in worker.application_instances.values()
+        )
+        received = await receive_many(channels, max_messages)
+        batches.append(len(received))
+        return received
+
+    channel_layer.receive_many = recording_receive_many
+    worker = Worker(
+        RecordingConsumer,
+        ["test-channel-1"],
+        channel_layer,
+        prefetch=3,
+        max_in_flight=2,
+    )
+    for n in range(5):
+        await channel_layer.send("test-channel-1", {"type": "test.message", "n": n})
+    await run_worker(worker, lambda: len(RecordingConsumer.received) == 5)
+    assert RecordingConsumer.received == [("test-channel-1", n) for n in range(5)]
+    assert batches == [3, 2]
+    assert max(queued) <= 2
+
+
+@pytest.mark.asyncio
+async def test_worker_full_instance():
+    """
+    Tests that an application instance with max_in_flight messages waiting
+    doesn't hold up messages for other channels, and gets its own once it
+    takes them.
+    """
+    release = asyncio.Event()
+
+    class SlowConsumer(AsyncConsumer):
+        received = []
+
+        async def test_message(self, message):
+            if self.scope["channel"] == "test-slow":
+                await release.wait()
+            self.received.append((self.scope["channel"], message["n"]))
+
+    channel_layer = InMemoryChannelLayer()
+    worker = Worker(
+        SlowConsumer, ["test-slow", "test-fast"], channel_layer, max_in_flight=1
+    )
+    # The consumer reads a couple ahead itself before any get parked
+    for n in range(10):
+        await channel_layer.send("test-slow", {"type": "test.message", "n": n})
+    task = asyncio.ensure_future(worker.handle())
+    try:
+        async with async_timeout.timeout(1):
+            while "test-slow" not in worker.parked:
+                await asyncio.sleep(0.01)
+            await channel_layer.send("test-fast", {"type": "test.message", "n": 0})
+            while ("test-fast", 0) not in SlowConsumer.received:
+                await asyncio.sleep(0.01)
+            # Parked messages stop the slow channel being read meanwhile
+            assert worker.stats()["channels"]["test-slow"]["queued"] <= 2
+            release.set()
+            while len(SlowConsumer.received) < 11:
+                await asyncio.sleep(0.01)
+        slow = [n for channel, n in SlowConsumer.received if channel == "test-slow"]
+        assert slow == list(range(10))
+        assert worker.parked == {}
+    finally:
+        task.cancel()
+        for details in worker.application_instances.values():
+            details["future"].cancel()
+
+
+@pytest.mark.asyncio
+async def test_worker_partitions():
+    """
+    Tests that a partitioned worker spreads a channel's messages over
+    several application instances, keeping each key's messages in order.
+    """
+
+    class PartitionConsumer(AsyncConsumer):
+        received = []
+
+        async def test_message(self, message):
+            self.received.append(
+                (self.scope["partition"], message["key"], message["n"])
+            )
+
+    channel_layer = InMemoryChannelLayer()
+    worker = Worker(PartitionConsumer, ["test-channel"], channel_layer, partitions=4)
+    for n in range(20):
+        await channel_layer.send(
+            "test-channel", {"type": "test.message", "key": n % 5, "n": n}
+        )
+    await run_worker(worker, lambda: len(PartitionConsumer.received) == 20)
+    partitions = {}
+    for partition, key, n in PartitionConsumer.received:
+        partitions.setdefault(key, set()).add(partition)
+        assert partition == worker.get_partition({"key": key})
+    # Each key sticks to one instance, and its messages stay in order
+    assert all(len(found) == 1 for found in partitions.values())
+    for key in range(5):
+        assert [n for _, k, n in PartitionConsumer.received if k == key] == list(
+            range(key, 20, 5)
+        )
+    assert len(worker.application_instances) > 1
+    assert all(key.startswith("test-channel#") for key in worker.application_instances)
+
+
+@pytest.mark.asyncio
+async def test_worker_stop():
+    """
+    Tests that stopping a worker makes it stop listening and return once its
+    application instances have taken their queued messages.
+    """
+    RecordingConsumer.received = []
+    channel_layer = InMemoryChannelLayer()
+    worker = Worker(RecordingConsumer, ["test-channel-1"], channel_layer)
+    await channel_layer.send("test-channel-1", {"type": "test.message", "n": 1})
+    handling = asyncio.ensure_future(worker.handle())
+    async with async_timeout.timeout(1):
+        while not RecordingConsumer.received:
+            await asyncio.sleep(0.01)
+    worker.stop()
+    async with async_timeout.timeout(1):
+        await handling
+    assert all(listener.cancelled() for listener in worker.listeners)
+    for details in worker.application_instances.values():
+        details["future"].cancel()
+
+
+def run_in_child(worker, ready):
+    """
+    Forks a child process that runs the worker with run(), then sends it
+    SIGTERM once ready() returns true. Returns the child's exit status.
+    """
+    pid = os.fork()
+    if not pid:
+        code = 1
+        try:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            worker.run()
+            code = 0
+        finally:
+            os._exit(code)
+    try:
+        deadline = time.monotonic() + 5
+        while not ready() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        os.kill(pid, signal.SIGTERM)
+        while time.monotonic() < deadline + 5:
+            exited, status = os.waitpid(pid, os.WNOHANG)
+            if exited:
+                return status
+            time.sleep(0.01)
+    except BaseException:
+        os.kill(pid, signal.SIGKILL)
+        raise
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    raise AssertionError("Worker didn't exit on SIGTERM")
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Needs os.fork()")
+def test_worker_run_sigterm(tmp_path):
+    """
+    Tests that a worker started with run() stops gracefully on SIGTERM.
+    """
+    started = tmp_path / "started"
+
+    class StartedWorker(Worker):
+        def start(self, loop):
+            super().start(loop)
+            started.touch()
+
+    worker = StartedWorker(
+        RecordingConsumer, ["test-channel-1"], InMemoryChannelLayer()
+    )
+    status = run_in_child(worker, started.exists)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Needs os.fork()")
+def test_worker_run_loop_options(tmp_path):
+    """
+    Tests that a worker started with run() applies its loop options to the
+    loop its application instances run on.
+    """
+    report = tmp_path / "report"
+
+    class ReportingConsumer(AsyncConsumer):
+        async def test_message(self, message):
+            loop = asyncio.get_event_loop()
+            task = asyncio.ensure_future(asyncio.sleep(0))
+            report.write_text(
+                "%s %s"
+                % (loop._default_executor._max_workers, hasattr(task, "from_factory"))
+            )
+            await task
+
+    beat = Beat(
+        [
+            BeatEntry(
+                "report",
+                "test-channel-1",
+                {"type": "test.message"},
+                IntervalSchedule(0.01),
+            )
+        ]
+    )
+    worker = Worker(
+        ReportingConsumer,
+        ["test-channel-1"],
+        InMemoryChannelLayer(),
+        beat=beat,
+        executor_workers=3,
+        task_factory="tests.test_loops.recording_task_factory",
+    )
+    status = run_in_child(worker, report.exists)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    assert report.read_text() == "3 True"
+
+
+@pytest.mark.asyncio
+async def test_worker_listener_error():
+    """
+    Tests that a worker stops, raising the error, when a listener fails, even
+    with a stats reporter that would otherwise run for ever.
+    """
+    channel_layer = InMemoryChannelLayer()
+    worker = Worker(
+        RecordingConsumer, ["test-channel-1"], channel_layer, stats_interval=0.01
+    )
+    await channel_layer.send("test-channel-1", {"n": 1})
+    with pytest.raises(ValueError):
+        async with async_timeout.timeout(1):
+            await worker.handle()
+    assert all(listener.done() for listener in worker.listeners)
+
+
+@pytest.mark.asyncio
+async def test_worker_stats(caplog):
+    """
+    Tests that a worker counts the messages it handles, and the application
+    instances it evicts and reaps.
+    """
+    RecordingConsumer.received = []
+    channel_layer = InMemoryChannelLayer()
+    worker = Worker(
+        RecordingConsumer,
+        ["test-channel-1", "test-channel-2"],
+        channel_layer,
+        max_applications=0,
+        stats_interval=0.05,
+    )
+    for n in range(3):
+        await channel_layer.send("test-channel-1", {"type": "test.message", "n": n})
+    await run_worker(worker, lambda: len(RecordingConsumer.received) == 3)
+    stats = worker.stats()
+    channel_stats = stats["channels"]["test-channel-1"]
+    assert channel_stats["messages"] == 3
+    assert channel_stats["rate"] > 0
+    assert channel_stats["instances"] == 1
+    assert channel_stats["queued"] == 0
+    assert 0 <= channel_stats["latency"]["p50"] <= channel_stats["latency"]["max"]
+    assert stats["channels"]["test-channel-2"]["messages"] == 0
+    assert stats["channels"]["test-channel-2"]["latency"]["p99"] is None
+    assert stats["instances"] == 1
+    assert stats["max_applications"] == 0
+    # Going over max_applications evicts the older instance
+    await channel_layer.send("test-channel-2", {"type": "test.message", "n": 4})
+    await run_worker(worker, lambda: len(RecordingConsumer.received) == 4)
+    assert worker.stats(reset=True)["evicted"] == 1
+    assert worker.stats()["channels"]["test-channel-1"]["messages"] == 0
+    # The checker reaps instances that have exited
+    checker = asyncio.ensure_future(worker.application_checker())
+    async with async_timeout.timeout(1):
+        while worker.application_instances:
+            await asyncio.sleep(0.01)
+    checker.cancel()
+    assert worker.stats()["reaped"] == 1
+
+    # With stats_interval set, the worker logs its stats
+    def stats_records():
+        return [record for record in caplog.records if hasattr(record, "stats")]
+
+    with caplog.at_level("INFO", "django.channels.worker"):
+        await run_worker(worker, stats_records)
+    assert stats_records()[0].stats["max_applications"] == 0
+
+
+@pytest.mark.asyncio
+async def test_adaptive_limiter():
+    """
+    Tests that the limiter opens up while messages are picked up quickly,
+    backs off once per slow spell, and holds listeners at the limit.
+    """
+    limiter = AdaptiveLimiter(target_latency=0.05, initial_limit=2, backoff=0.5)
+    assert await limiter.acquire() == 2
+    for _ in range(2):
+        limiter.started()
+        limiter.done(time.monotonic())
+    assert limiter.limit == pytest.approx(2.5 + 1 / 2.5)
+    # Two slow messages from the same spell only cut the limit once
+    for _ in range(2):
+        limiter.started()
+    limiter.done(time.monotonic() - 1)
+    limiter.done(time.monotonic() - 1)
+    assert limiter.limit == pytest.approx((2.5 + 1 / 2.5) / 2)
+    # Listeners wait while the limit is reached
+    limiter.started()
+    acquiring = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0.01)
+    assert not acquiring.done()
+    limiter.release(1)
+    assert await acquiring == 1
+    assert limiter.stats() == {"limit": 1, "in_flight": 0, "throttled": 1}
+
+
+@pytest.mark.asyncio
+async def test_worker_limiter():
+    """
+    Tests that a worker with a limiter takes fewer messages at a time when
+    its application instance falls behind.
+    """
+
+    class SlowConsumer(AsyncConsumer):
+        received = []
+
+        async def test_message(self, message):
+            await asyncio.sleep(0.02)
+            self.received.append(message["n"])
+
+    channel_layer = InMemoryChannelLayer()
+    limiter = AdaptiveLimiter(target_latency=0.01)
+    worker = Worker(
+        SlowConsumer, ["test-channel-1"], channel_layer, prefetch=5, limiter=limiter
+    )
+    for n in range(20):
+        await channel_layer.send("test-channel-1", {"type": "test.message", "n": n})
+    await run_worker(worker, lambda: len(SlowConsumer.received) == 20)
+    assert SlowConsumer.received == list(range(20))
+    stats = worker.stats()["limiter"]
+    assert stats["limit"] < 10
+    assert stats["throttled"] > 0
+    assert stats["in_flight"] == 0